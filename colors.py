@@ -4,6 +4,14 @@
 # Author: Christian Felipe Álvarez <sigilioso@gmail.com>
 #
 
+from array import array
+from ctypes import Array
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 def color(pixel, colour='blue', increment=90):
 	"""
 	Defines the color of a pixel depending on the distance from the point 
@@ -32,3 +40,165 @@ def color_pixels(p, maxIt, colour='blue'):
 	return tuple(color(pixel, colour))
 
 
+
+class Palette:
+	"""
+	The colors of every iteration count in [0, maxIt] (as `color_pixels`
+	defines them) computed once, so coloring a pixel is just a lookup.
+	Fractional counts use the color of their integer part.
+	For indexed PNG files (see `entries`) the counts are mapped to at most
+	256 palette indexes.
+	`levels` can give the value in [0, 255] of each count instead of the
+	linear ``255 * e / maxIt`` (see `equalized`).
+	If `smooth`, colors of fractional counts (see `Fractals` smooth option)
+	are interpolated between the ones of the counts around them.
+	"""
+	def __init__(self, maxIt, colour='blue', increment=90, levels=None,
+			smooth=False):
+		self.maxIt = maxIt
+		self.colour = colour
+		self.increment = increment
+		self.smooth = smooth
+		def to_byte(e):
+			if e == maxIt:
+				return 0
+			if levels is not None:
+				return levels[e]
+			return 255 * float(e) / maxIt
+		# Bytes are truncated as png.Writer does with float values
+		self.colors = [tuple([int(b) for b in
+			color(map(to_byte, [e, e, e]), colour, increment)])
+			for e in range(maxIt + 1)]
+		self.strings = [array('B', c).tostring() for c in self.colors]
+		# Palette index of each count and colors of the palette entries
+		if maxIt < 256:
+			self.indexes = range(maxIt + 1)
+			self.entries = list(self.colors)
+		else:
+			self.indexes = [e * 255 // maxIt for e in range(maxIt + 1)]
+			self.entries = [self.colors[i * maxIt // 255] for i in range(256)]
+		self.index_strings = [chr(i) for i in self.indexes]
+		if numpy is not None:
+			self.table = numpy.array(self.colors, numpy.uint8)
+			self.index_table = numpy.array(self.indexes, numpy.uint8)
+
+	def pixel(self, p):
+		"""
+		Returns the (red, green, blue) color of the iteration count `p`
+		"""
+		e = int(p)
+		if not self.smooth or e == p or e >= self.maxIt - 1:
+			return self.colors[e]
+		f = p - e
+		return tuple([int(a + (b - a) * f) for a, b in
+			zip(self.colors[e], self.colors[e + 1])])
+
+	def row(self, row):
+		"""
+		Returns the colors of a row of iteration counts as an array of bytes
+		(red, green, blue, red, ...), which is ready for `png.Writer.write_packed`
+		"""
+		if numpy is not None and isinstance(row, Array):
+			row = numpy.ctypeslib.as_array(row)
+		if self.smooth:
+			if numpy is not None and isinstance(row, numpy.ndarray):
+				return array('B', self.__blend(row).tostring())
+			out = array('B')
+			for p in row:
+				out.extend(self.pixel(p))
+			return out
+		return self.__lookup(row, self.strings, 'table')
+
+	def index_row(self, row):
+		"""
+		Returns the palette indexes of a row of iteration counts as an array of
+		bytes, for a `png.Writer` created with ``palette=self.entries``
+		"""
+		return self.__lookup(row, self.index_strings, 'index_table')
+
+	def image(self, rows):
+		"""
+		Generator of the colored rows (see `row`) of a table (or any iterable
+		of rows) of iteration counts. If numpy is available, tables returned by
+		`Fractals` are colored all at once.
+		"""
+		return self.__image(rows, self.row, 'table')
+
+	def index_image(self, rows):
+		"""
+		Same as `image` but the rows are of palette indexes (see `index_row`)
+		"""
+		return self.__image(rows, self.index_row, 'index_table')
+
+	def __lookup(self, row, strings, table):
+		"""
+		Returns the bytes of `strings` (or of the numpy array called `table`)
+		of each count in `row`
+		"""
+		if numpy is not None and isinstance(row, Array):
+			row = numpy.ctypeslib.as_array(row)
+		if numpy is not None and isinstance(row, numpy.ndarray):
+			table = getattr(self, table)
+			return array('B', table[row.astype(numpy.intp)].tostring())
+		return array('B', ''.join([strings[int(p)] for p in row]))
+
+	def __blend(self, counts):
+		"""
+		Returns the interpolated colors of a numpy array of fractional counts
+		"""
+		e = counts.astype(numpy.intp)
+		f = (counts - e)[..., numpy.newaxis]
+		upper = numpy.minimum(e + 1, self.maxIt - 1)
+		f[e >= self.maxIt - 1] = 0
+		low = self.table[e]
+		return (low + (self.table[upper] - low.astype(float)) * f).astype(
+			numpy.uint8)
+
+	def __image(self, rows, lookup, table):
+		"""
+		Generator of the rows of `lookup` for a table of counts
+		"""
+		if numpy is not None and isinstance(rows, Array):
+			rows = numpy.ctypeslib.as_array(rows)
+		if numpy is not None and isinstance(rows, numpy.ndarray) \
+				and rows.ndim == 2:
+			if self.smooth and table == 'table':
+				colored = self.__blend(rows)
+			else:
+				colored = getattr(self, table)[rows.astype(numpy.intp)]
+			for row in colored:
+				yield array('B', row.tostring())
+			return
+		for row in rows:
+			yield lookup(row)
+
+# Palettes already computed, by (maxIt, colour, increment, smooth)
+_palettes = {}
+
+def palette(maxIt, colour='blue', increment=90, smooth=False):
+	"""
+	Returns the `Palette` for `maxIt`, `colour`, `increment` and `smooth`,
+	computing it only the first time it is required
+	"""
+	key = (maxIt, colour, increment, smooth)
+	if key not in _palettes:
+		_palettes[key] = Palette(maxIt, colour, increment, smooth=smooth)
+	return _palettes[key]
+
+def equalized(histogram, colour='blue', increment=90, smooth=False):
+	"""
+	Returns a `Palette` whose levels are equalized for `histogram` (the number
+	of pixels of each iteration count, see `Fractals.histogram`): each count
+	gets a level proportional to the pixels that escape in as many iterations
+	or less, so the levels are spread over the colors really used.
+	The histogram is gathered while rendering, so for streamed rows or tiles
+	it can be the one of a previous frame or of a small preview render.
+	"""
+	maxIt = len(histogram) - 1
+	escaped = float(sum(histogram[:maxIt])) or 1.0
+	levels = []
+	total = 0
+	for n in histogram[:maxIt]:
+		total += n
+		levels.append(255 * total / escaped)
+	return Palette(maxIt, colour, increment, levels, smooth)
@@ -6,25 +6,164 @@ fractals.py
 Module which include a class to manage fractals representations
 """
 
-from multiprocessing import Process
-from multiprocessing.sharedctypes import Value
-from ctypes import c_double
+from multiprocessing import Pool
+from collections import deque
+import itertools
+from decimal import Decimal, localcontext
+from fractions import Fraction
+import copy
+from ctypes import c_double, c_uint8, c_uint16, c_uint32, sizeof
+import numbers
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Available ways of calculating the escape-time tables
+ENGINES = ('python', 'numpy')
+# Available ways of returning the tables
+OUTPUTS = ('table', 'list', 'numpy')
+# Available arithmetics for the coordinates of the pixels
+PRECISIONS = ('auto', 'single', 'double', 'double-double', 'perturbation',
+        'fixed')
+# Precisions that 'auto' can choose, from the cheapest, with the smallest
+# pixel spacing (relative to the coordinates) for which each one agrees with
+# 'fixed' but for a few pixels of the boundary. 'double-double' is slower
+# than 'perturbation' and 'fixed' with both engines, so it is not chosen.
+AUTO_PRECISIONS = ((1e-2, 'single'), (1e-8, 'double'), (0, 'perturbation'),
+        (0, 'fixed'))
+# An iteration of the numpy engine over a few pixels costs about as much as
+# ARRAY_OVERHEAD iterations of a pixel with python
+ARRAY_OVERHEAD = 16
+# A perturbed pixel is glitched when |Z + dz| < GLITCH_TOLERANCE * |Z|
+GLITCH_TOLERANCE = 1e-3
+# Maximun number of reference orbits used to calculate a block
+MAX_REFERENCES = 16
 
 class Fractals:
     """
     A Class to manage fractals representations
     """
 
-    def __init__(self, num_procs=1):
+    def __init__(self, num_procs=1, engine='python', chunk_size=4,
+            output='table', compact=False, periodicity=False, tolerance=1e-12,
+            subdivide=False, tile_size=64, collect_histogram=False,
+            smooth=False, precision='double', symmetry=False):
         """
         Create a new instance of Fractals specifiying optionally the number of
         proccesses that are going to be used to create fractals.
-        `num_procs`: default=1, a number in [1, 2, ..., 20] is required.
+        `num_procs`: default=1, a positive number is required.
+        `engine`: default='python', one of `ENGINES` ('numpy' needs numpy).
+        `chunk_size`: default=4, the rows a process takes each time.
+        `output`: default='table', one of `OUTPUTS`, what the renders return.
+        `compact`: default=False, store the counts in the smallest integers.
+        `periodicity`: default=False, detect cycles, see `in_mandelbrot`.
+        `tolerance`: default=1e-12, how close an orbit must come to a cycle.
+        `subdivide`: default=False, use Mariani-Silver, see `calculate_rect`.
+        `tile_size`: default=64, the side of the tiles of `subdivide`.
+        `collect_histogram`: default=False, count the pixels in `histogram`.
+        `smooth`: default=False, fractional counts in [i, i + 1) if escaping.
+        `precision`: default='double', one of `PRECISIONS`, see below.
+        `symmetry`: default=False, copy mirrored rows, see `__mirrors`.
+        The processes are started the first time they are needed and reused by
+        every render until `close` is called (or the `with` block that uses
+        this instance ends). The precisions are described in `calculate_rows`.
         """
         self.num_procs = num_procs
-        if num_procs < 1 or num_procs > 20:
+        if num_procs < 1:
+            raise Exception("""Value not valid
+                    num_procs has to be a positive number""")
+        self.chunk_size = chunk_size
+        if chunk_size < 1:
+            raise Exception("""Value not valid
+                    chunk_size has to be a positive number""")
+        if engine not in ENGINES:
             raise Exception("""Value not valid
-                    num_procs has to be in [1, 2, ..., 20]""")
+                    engine has to be one of %s""" % (ENGINES,))
+        if engine == 'numpy' and numpy is None:
+            raise Exception("The numpy engine requires numpy to be installed")
+        self.engine = engine
+        if output not in OUTPUTS:
+            raise Exception("""Value not valid
+                    output has to be one of %s""" % (OUTPUTS,))
+        if output == 'numpy' and numpy is None:
+            raise Exception("The numpy output requires numpy to be installed")
+        self.output = output
+        self.compact = compact
+        self.periodicity = periodicity
+        self.tolerance = tolerance
+        self.subdivide = subdivide
+        self.collect_histogram = collect_histogram
+        self.smooth = smooth
+        self.histogram = None
+        if precision not in PRECISIONS:
+            raise Exception("""Value not valid
+                    precision has to be one of %s""" % (PRECISIONS,))
+        if precision == 'single' and engine != 'numpy':
+            raise Exception("The single precision requires the numpy engine")
+        self.precision = precision
+        self.chosen_precision = None
+        self.symmetry = symmetry
+        self.tile_size = tile_size
+        if tile_size < 4:
+            raise Exception("""Value not valid
+                    tile_size has to be at least 4""")
+        self.__pool = None
+
+    def __getstate__(self):
+        """
+        The pool of processes is not sent to the processes themselves, nor
+        the results of the renders (`histogram` and `chosen_precision`)
+        """
+        state = self.__dict__.copy()
+        state['_Fractals__pool'] = None
+        state['histogram'] = None
+        state['chosen_precision'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stop the processes used to create fractals, if they were started
+        """
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def __get_pool(self):
+        """
+        Returns the pool of `num_procs` processes, starting it if needed
+        """
+        if self.__pool is None:
+            self.__pool = Pool(self.num_procs)
+        return self.__pool
+
+    def reset_histogram(self):
+        """
+        Forget the pixels counted in `histogram`, which is also reset by a
+        render with other `max_it`
+        """
+        self.histogram = None
+
+    def __add_histogram(self, histogram, max_it):
+        """
+        Add the `histogram` of a block to the one of this instance. Each
+        process counts the pixels of its blocks and `histogram` (a list of
+        `max_it` + 1 numbers) adds them as the blocks arrive, so tiles and
+        streamed rows are counted too.
+        """
+        if self.histogram is None or len(self.histogram) != max_it + 1:
+            self.histogram = [0] * (max_it + 1)
+        for i, n in enumerate(histogram):
+            self.histogram[i] += n
 
     def in_mandelbrot(self, c=complex(0.7,1.5), max_it=100):
         """
@@ -32,15 +171,51 @@ class Fractals:
         number of iterations.
         Returns `max_it` if `c` is in the Mandelbrot set, and returns the number of
         iterations needed to discover that `c` is not in the Mandelbrot set otherwise.
+        With `periodicity` the iterations stop when the orbit comes back
+        (within `tolerance`) to a saved point of the orbit, which is saved
+        again after 1, 3, 7, 15, ... iterations (Brent's method), and the
+        cycle is attracting: the derivative of the iterations since the saved
+        point is smaller than 1. Orbits which only pass near a repelling cycle
+        go on iterating, so the counts are the same as without the check.
+        `in_julia` does not check Julia sets of exponents smaller than 1.
         """
-        z = complex(0, 0)
+        if self.in_main_bulbs(c):
+            return max_it
+        z = saved = complex(0, 0)
+        derivative = 1
         for i in range(0, max_it):
             if abs(z) > 4:
+                if self.smooth:
+                    return max(_smooth(i, abs(z), 2), i)
                 return i
             else:
+                if self.periodicity:
+                    derivative *= 2 * z
                 z = z**2 + c
+            if self.periodicity:
+                if abs(z - saved) < self.tolerance and abs(derivative) < 1:
+                    return max_it
+                if (i + 2) & (i + 1) == 0:
+                    saved = z
+                    derivative = 1
         return max_it
 
+    def in_main_bulbs(self, c):
+        """
+        Determine if a complex number c is inside the main cardioid or the
+        period-2 bulb of the Mandelbrot set, which are known to be in the set
+        without iterating. `c` can also be a numpy array, then an array of
+        booleans is returned.
+        """
+        x = c.real - 0.25
+        y2 = c.imag * c.imag
+        q = x * x + y2
+        cardioid = q * (q + x) < 0.25 * y2
+        bulb = (c.real + 1) * (c.real + 1) + y2 < 0.0625
+        if numpy is not None and isinstance(c, numpy.ndarray):
+            return cardioid | bulb
+        return cardioid or bulb
+
     def in_julia(self, z=complex(0,0), c=complex(0.742,0.1), exp=2, max_it=100):
         """
         Determine if a complex number z is in the Julia J(c) set for a maximum number
@@ -48,68 +223,804 @@ class Fractals:
         Returns `max_it` if `c` is in this Julia set, and returns the number of
         iterations needed to discover that `c` is not in J(c) set otherwise.
         """
+        # The derivative is not defined at 0 for exponents smaller than 1
+        periodicity = self.periodicity and exp >= 1
+        saved = z
+        derivative = 1
         for i in range(0, max_it):
             if abs(z**2) > 4:
+                if self.smooth and abs(exp) > 1:
+                    return max(_smooth(i, abs(z**2), exp), i)
                 return i
             else:
+                if periodicity:
+                    derivative *= exp * z**(exp - 1)
                 z = z**exp + c
+            if periodicity:
+                if abs(z - saved) < self.tolerance and abs(derivative) < 1:
+                    return max_it
+                if (i + 2) & (i + 1) == 0:
+                    saved = z
+                    derivative = 1
         return max_it
 
+    def array_mandelbrot(self, c, max_it=100):
+        """
+        Same as `in_mandelbrot` but for a numpy array `c` of complex numbers.
+        Returns an array (with the shape of `c`) of iteration counts.
+        """
+        return self.__iterate(numpy.zeros(c.shape,
+                numpy.result_type(c, numpy.complex64)), c, 2,
+                max_it, False, ~self.in_main_bulbs(c))
+
+    def array_julia(self, z, c=complex(0.742,0.1), exp=2, max_it=100):
+        """
+        Same as `in_julia` but for a numpy array `z` of complex numbers.
+        Returns an array (with the shape of `z`) of iteration counts.
+        """
+        z = numpy.asarray(z)
+        return self.__iterate(numpy.array(z,
+            numpy.result_type(z, numpy.complex64)), c, exp, max_it, True)
+
+    def fixed_mandelbrot(self, c, max_it=100, bits=None):
+        """
+        Same as `in_mandelbrot` iterating in fixed point: the parts of the
+        complex numbers are integers scaled by 2^`bits`, so `c` can also be a
+        pair (real, imaginary) of strings, Decimals or Fractions as precise as
+        needed. If `bits` is None, it is taken from the digits of `c`.
+        """
+        if bits is None:
+            bits = _fixed_bits(c)
+        return self.__fixed_count(None, _fixed_pair(c, bits), 2, max_it, bits)
+
+    def fixed_julia(self, z, c=complex(0.742,0.1), exp=2, max_it=100,
+            bits=None):
+        """
+        Same as `in_julia` iterating in fixed point as `fixed_mandelbrot`, for
+        a positive integer `exp`. Both `z` and `c` can be pairs of strings,
+        Decimals or Fractions.
+        """
+        if bits is None:
+            bits = _fixed_bits(z, c)
+        return self.__fixed_count(_fixed_pair(z, bits), _fixed_pair(c, bits),
+                exp, max_it, bits)
+
+    def __fixed_count(self, z, c, exp, max_it, bits):
+        """
+        Returns the iteration count (smooth if required) of the fixed point
+        `z` for J(c), or of `c` for the Mandelbrot set if `z` is None
+        """
+        julia = z is not None
+        if not julia:
+            if _fixed_in_main_bulbs(c, bits):
+                return max_it
+            z = (0, 0)
+        count, modulus = _fixed_iterate(z, c, exp, max_it, bits, julia)
+        if count == max_it or not self.smooth or abs(exp) <= 1:
+            return count
+        value = _fixed_float(modulus, bits)
+        if not julia:
+            value = math.sqrt(value)
+        return max(_smooth(count, value, exp), count)
+
+    def __iterate(self, z, c, exp, max_it, julia, escaping=None):
+        """
+        Iterate z' = z^exp + c for every element of `z` at the same time.
+        The pixels that are still escaping are kept in compacted arrays (with
+        `index` pointing to their positions in the result), so the escaped ones
+        are not iterated anymore. If `escaping` is given, only the elements
+        where it is True are iterated and the others get `max_it`.
+        The orbits are checked for attracting cycles as in `in_mandelbrot`.
+        As this doubles the operations of each iteration, the pixels still
+        iterating are calculated again one by one with python when that is
+        cheaper (see `ARRAY_OVERHEAD`), usually when a few of them go on
+        after the others are found in the set.
+        """
+        shape = z.shape
+        counts = numpy.empty(z.size)
+        counts.fill(max_it)
+        if escaping is None:
+            index = numpy.arange(z.size)
+        else:
+            index = numpy.flatnonzero(escaping)
+        points = z.ravel() if julia else numpy.asarray(c).ravel()
+        z = z.ravel()[index]
+        c = numpy.asarray(c, z.dtype)
+        if c.ndim:
+            c = c.ravel()[index]
+        periodicity = self.periodicity and exp >= 1
+        saved = z
+        derivative = numpy.ones(z.shape, z.dtype)
+        for i in range(0, max_it):
+            if not index.size:
+                break
+            if (periodicity and z.dtype == complex and
+                    index.size * max_it < ARRAY_OVERHEAD * (max_it - i)):
+                for n in index:
+                    if julia:
+                        counts[n] = self.in_julia(complex(points[n]),
+                                complex(c), exp, max_it)
+                    else:
+                        counts[n] = self.in_mandelbrot(complex(points[n]),
+                                max_it)
+                break
+            if julia:
+                values = abs(_power(z, 2))
+            else:
+                values = abs(z)
+            escaped = values > 4
+            if escaped.any():
+                if self.smooth and abs(exp) > 1:
+                    counts[index[escaped]] = numpy.maximum(
+                        _smooth(i, values[escaped], exp, numpy.log), i)
+                else:
+                    counts[index[escaped]] = i
+                escaping = ~escaped
+                z = z[escaping]
+                saved = saved[escaping]
+                derivative = derivative[escaping]
+                index = index[escaping]
+                if c.ndim:
+                    c = c[escaping]
+            if periodicity:
+                derivative *= exp * _power(z, exp - 1)
+            z = _power(z, exp) + c
+            if periodicity:
+                # The cyclic ones already have `max_it` as count
+                cyclic = ((abs(z - saved) < self.tolerance) &
+                        (abs(derivative) < 1))
+                if cyclic.any():
+                    escaping = ~cyclic
+                    z = z[escaping]
+                    saved = saved[escaping]
+                    derivative = derivative[escaping]
+                    index = index[escaping]
+                    if c.ndim:
+                        c = c[escaping]
+                if (i + 2) & (i + 1) == 0:
+                    saved = z
+                    derivative = numpy.ones(z.shape, z.dtype)
+        return counts.reshape(shape)
+
     def __increment(self, length, minimun, maximun):
         """
         Returns the dinstance between `maximun` and `minimun`
         """
         return (maximun - minimun) / length
 
-    def mandelbrot(self, minimun, maximun, width, height, max_it):
+    def __cell_type(self, max_it):
         """
-        Get a table representation of a Mandelbrot set (for `max_it` iterations)
-        whose size is `width` x `height`.
-        `minimun` and `maximun` are, respectively, the minimun and maximun complex
-        numbers that are represented (minimun in the bottom-left and maximun in
-        the top-right)
+        Returns the ctypes type used to store each value of a table, the
+        smallest unsigned integer able to hold `max_it` if `compact`
+        """
+        if self.compact and not self.smooth:
+            for ctype in (c_uint8, c_uint16, c_uint32):
+                if max_it < 2 ** (8 * sizeof(ctype)):
+                    return ctype
+        return c_double
+
+    def __dtype(self):
+        """
+        Returns the numpy type of the complex numbers iterated by the numpy
+        engine, complex64 (two float32) for the 'single' precision
+        """
+        if self.precision == 'single':
+            return numpy.complex64
+        return complex
+
+    def __axis(self, start, increment, length):
+        """
+        Returns the `length` values of an axis starting in `start`. Values are
+        accumulated (not multiplied) so every engine gets the same coordinates
         """
-        inc_real = self.__increment(width, minimun.real, maximun.real)
-        inc_imag = self.__increment(height, minimun.imag, maximun.imag)
+        values = []
+        for i in range(length):
+            values.append(start)
+            start += increment
+        return values
 
-        #Use this function to calculate some colums with each process
-        def calculate(image, num_procs=1, id_proc=0):
+    def calculate_rows(self, kind, params, reals, imags, max_it):
+        """
+        Returns the rows (one for each value in `imags`) of iteration counts
+        of the `kind` ('mandelbrot' or 'julia') fractal. 'python' calls
+        `in_mandelbrot` or `in_julia` for each pixel and 'numpy' iterates all
+        the pixels at once as arrays, both engines return the same values.
+        This is used by the 'double' precision, where the coordinates are
+        python floats, which become the same value for neighbour pixels below
+        a pixel spacing of about 1e-13, and by 'single' (numpy engine only),
+        the cheapest for views where the pixels are not smaller than about
+        1e-2. The deeper precisions are calculated by `__double_double_rows`,
+        `calculate_perturbation` and `calculate_fixed`, and 'auto' chooses
+        one of them for each render (see `__choose`).
+        """
+        if self.precision == 'double-double':
+            return self.__double_double_rows(kind, params, reals, imags,
+                    max_it)
+        if self.engine == 'numpy':
+            grid = numpy.empty((len(imags), len(reals)), self.__dtype())
+            grid.real = numpy.array(reals)
+            grid.imag = numpy.array(imags)[:, numpy.newaxis]
+            if kind == 'mandelbrot':
+                return self.array_mandelbrot(grid, max_it)
+            c, exp = params
+            return self.array_julia(grid, c, exp, max_it)
+        rows = []
+        for ch in imags:
+            if kind == 'mandelbrot':
+                rows.append([self.in_mandelbrot(c=complex(cw, ch), max_it=max_it)
+                    for cw in reals])
+            else:
+                c, exp = params
+                rows.append([self.in_julia(complex(cw, ch), c, exp, max_it)
+                    for cw in reals])
+        return rows
+
+    def __double_double_rows(self, kind, params, reals, imags, max_it):
+        """
+        Same as `calculate_rows` for the 'double-double' precision, `reals`
+        and `imags` are pairs of floats (high and low parts). The pairs are
+        unevaluated sums of two floats (about 32 significant digits) iterated
+        with exact float operations (error-free sums and products), which
+        resolves pixel spacings down to about 1e-30. Julia sets require a
+        positive integer exponent.
+        """
+        if kind == 'mandelbrot':
+            exp = 2
+        else:
+            c, exp = params
+            c = ((c.real, 0.0), (c.imag, 0.0))
+        julia = kind == 'julia'
+        if self.engine == 'numpy':
+            shape = (len(imags), len(reals))
+            real = [numpy.empty(shape), numpy.empty(shape)]
+            imag = [numpy.empty(shape), numpy.empty(shape)]
+            for part in (0, 1):
+                real[part][:] = [pair[part] for pair in reals]
+                imag[part][:] = numpy.array(
+                    [pair[part] for pair in imags])[:, numpy.newaxis]
+            counts = numpy.empty(real[0].size)
+            counts.fill(max_it)
+            point = tuple((hi.ravel(), lo.ravel()) for hi, lo in (real, imag))
+            if julia:
+                index = numpy.arange(counts.size)
+                z = point
+            else:
+                index = numpy.flatnonzero(~self.in_main_bulbs(
+                    real[0].ravel() + 1j * imag[0].ravel()))
+                c = _dd_take(point, index)
+                zero = numpy.zeros(index.size)
+                z = ((zero, zero), (zero, zero))
+            for i in range(0, max_it):
+                if not index.size:
+                    break
+                values = z[0][0] * z[0][0] + z[1][0] * z[1][0]
+                if not julia:
+                    values = numpy.sqrt(values)
+                escaped = values > 4
+                if escaped.any():
+                    if self.smooth:
+                        counts[index[escaped]] = numpy.maximum(
+                            _smooth(i, values[escaped], exp, numpy.log), i)
+                    else:
+                        counts[index[escaped]] = i
+                    remaining = ~escaped
+                    z = _dd_take(z, remaining)
+                    index = index[remaining]
+                    if not julia:
+                        c = _dd_take(c, remaining)
+                z = _dd_iterate(z, c, exp)
+            return counts.reshape(shape)
+        rows = []
+        for im in imags:
+            row = []
+            for re in reals:
+                if julia:
+                    z = (re, im)
+                else:
+                    c = (re, im)
+                    if self.in_main_bulbs(complex(re[0], im[0])):
+                        row.append(max_it)
+                        continue
+                    z = ((0.0, 0.0), (0.0, 0.0))
+                count = max_it
+                for i in range(0, max_it):
+                    value = z[0][0] * z[0][0] + z[1][0] * z[1][0]
+                    if not julia:
+                        value = math.sqrt(value)
+                    if value > 4:
+                        if self.smooth:
+                            count = max(_smooth(i, value, exp), i)
+                        else:
+                            count = i
+                        break
+                    z = _dd_iterate(z, c, exp)
+                row.append(count)
+            rows.append(row)
+        return rows
+
+    def calculate_points(self, kind, params, points, max_it):
+        """
+        Returns the iteration counts of the `kind` fractal for a list of
+        complex `points`.
+        """
+        if kind == 'mandelbrot':
+            if self.engine == 'numpy':
+                return self.array_mandelbrot(numpy.array(points,
+                    self.__dtype()), max_it)
+            return [self.in_mandelbrot(c=c, max_it=max_it) for c in points]
+        c, exp = params
+        if self.engine == 'numpy':
+            return self.array_julia(numpy.array(points, self.__dtype()),
+                    c, exp, max_it)
+        return [self.in_julia(z, c, exp, max_it) for z in points]
+
+    def calculate_rect(self, kind, params, reals, imags, max_it):
+        """
+        Same as `calculate_rows` but using the Mariani-Silver algorithm, the
+        values are returned as a list of rows. Only the border of each
+        rectangle is calculated and, if all its values are the same, the
+        rectangle is filled with it, otherwise it is divided in four. As the
+        sets are connected this gets the same table, except for details
+        thinner than a pixel inside a rectangle.
+        """
+        values = [[None] * len(reals) for ch in imags]
+
+        def compute(pixels):
             """
-            Each process has to calculate some colums, for example if there is
-            two process:
-            proc 0 will calculate colums 0, 2, 4, ...
-            proc 1 will calculate colums 1, 3, 5, ...
+            Calculate the `pixels` (pairs of row and column) that were not
+            calculated yet, all at once
             """
-            ch = minimun.imag
-            cw = minimun.real
-            ch += id_proc*inc_imag
-            for w in range(id_proc, height, num_procs):
-                for h in range(width):
-                    image[w][h] = self.in_mandelbrot(c=complex(cw, ch), max_it=max_it)
-                    cw += inc_real
-                ch += num_procs * inc_imag
-                cw = minimun.real
-
-        # Create the image as a c_double table
-        Image = (c_double * width) * height
-        # Use shared memory to store the image
-        image = Value(Image)
+            pixels = [(y, x) for y, x in pixels if values[y][x] is None]
+            if not pixels:
+                return
+            points = [complex(reals[x], imags[y]) for y, x in pixels]
+            for (y, x), value in zip(pixels,
+                    self.calculate_points(kind, params, points, max_it)):
+                values[y][x] = value
+
+        def pixels(x0, y0, x1, y1):
+            """
+            Returns the pixels of a rectangle which have to be calculated:
+            its border, or all of them if it is too small to be divided
+            """
+            if x1 - x0 < 4 or y1 - y0 < 4:
+                return [(y, x) for y in range(y0, y1) for x in range(x0, x1)]
+            return ([(y, x) for y in (y0, y1 - 1) for x in range(x0, x1)] +
+                [(y, x) for y in range(y0 + 1, y1 - 1) for x in (x0, x1 - 1)])
+
+        # Rectangles of columns [x0, x1) and rows [y0, y1), all the ones of
+        # the same level are calculated at once
+        rects = [(0, 0, len(reals), len(imags))]
+        while rects:
+            compute([pixel for rect in rects for pixel in pixels(*rect)])
+            children = []
+            for x0, y0, x1, y1 in rects:
+                if x1 - x0 < 4 or y1 - y0 < 4:
+                    continue
+                border = set(values[y][x] for y, x in pixels(x0, y0, x1, y1))
+                if len(border) == 1:
+                    value = border.pop()
+                    for y in range(y0 + 1, y1 - 1):
+                        values[y][x0 + 1:x1 - 1] = [value] * (x1 - x0 - 2)
+                    continue
+                # Children share the middle lines so they are calculated once
+                xm = (x0 + x1) // 2
+                ym = (y0 + y1) // 2
+                children += [(x0, y0, xm + 1, ym + 1), (xm, y0, x1, ym + 1),
+                        (x0, ym, xm + 1, y1), (xm, ym, x1, y1)]
+            rects = children
+        return values
+
+    def calculate_fixed(self, kind, params, reals, imags, max_it, bits):
+        """
+        Same as `calculate_rows` for the 'fixed' precision, `reals` and
+        `imags` are integers scaled by 2^`bits`, the bits needed for the pixel
+        spacing (see `fixed_mandelbrot`). It is exact at any zoom but slow.
+        Julia sets require a positive integer exponent.
+        """
+        if kind == 'mandelbrot':
+            rows = [[self.__fixed_count(None, (cw, ch), 2, max_it, bits)
+                for cw in reals] for ch in imags]
+        else:
+            c, exp = params
+            c = _fixed_pair(c, bits)
+            rows = [[self.__fixed_count((cw, ch), c, exp, max_it, bits)
+                for cw in reals] for ch in imags]
+        if self.engine == 'numpy':
+            return numpy.array(rows, float)
+        return rows
+
+    def calculate_perturbation(self, kind, params, reals, imags, max_it,
+            context, first, left):
+        """
+        Same as `calculate_rows` for the 'perturbation' precision. `reals` and
+        `imags` are the differences of the pixels with the reference pixel of
+        `context`, and `first` and `left` the row and column of the first pixel
+        in the whole table, needed to get a new reference point when there are
+        glitched pixels. The orbit of the reference is calculated in fixed
+        point precise enough for the pixel spacing, and each pixel is iterated
+        as a difference dz from it with floats (dz' = 2*Z*dz + dz^2 + dc). A
+        pixel is glitched when |Z + dz| is much smaller than |Z| or its orbit
+        is longer than the reference one, then it is calculated again with a
+        glitched pixel of the block as reference. The pixels still glitched
+        after `MAX_REFERENCES` references are calculated in fixed point.
+        Julia sets require exponent 2.
+        """
+        origin, step, digits = (context['origin'], context['step'],
+                context['digits'])
+        pixels = [(y, x) for y in range(len(imags)) for x in range(len(reals))]
+        deltas = [complex(reals[x], imags[y]) for y, x in pixels]
+        column, row = context['reference']
+        orbit = _cached_orbit(kind, params, _pixel(origin, step, column, row,
+            digits), max_it, digits)
+        values = [[None] * len(reals) for ch in imags]
+        for references in range(MAX_REFERENCES):
+            counts, glitched = self.__perturb(kind, deltas, orbit, max_it)
+            for (y, x), count in zip(pixels, counts):
+                values[y][x] = count
+            pixels = [pixels[n] for n in glitched]
+            if not pixels or references == MAX_REFERENCES - 1:
+                break
+            # The glitched pixels are calculated again with one of them as
+            # reference, its differences with the others are exact multiples
+            # of the pixel spacing
+            y0, x0 = pixels[len(pixels) // 2]
+            orbit = _reference_orbit(kind, params, _pixel(origin, step,
+                left + x0, first + y0, digits), max_it, digits)
+            deltas = [complex((x - x0) * float(step[0]),
+                (y - y0) * float(step[1])) for y, x in pixels]
+        bits = _digits_bits(digits)
+        for y, x in pixels:
+            point = _fixed_pair(_pixel(origin, step, left + x, first + y,
+                digits), bits)
+            if kind == 'mandelbrot':
+                values[y][x] = self.__fixed_count(None, point, 2, max_it, bits)
+            else:
+                values[y][x] = self.__fixed_count(point,
+                        _fixed_pair(params[0], bits), 2, max_it, bits)
+        if self.engine == 'numpy':
+            return numpy.array(values)
+        return values
+
+    def __perturb(self, kind, deltas, orbit, max_it):
+        """
+        Iterate the differences with the reference `orbit` of the points at
+        `deltas` (for a Julia set the orbit begins in the reference point).
+        Returns the iteration counts and the positions in `deltas` of the
+        glitched points, whose counts are not valid.
+        """
+        julia = kind == 'julia'
+        if self.engine == 'numpy':
+            counts = numpy.empty(len(deltas))
+            counts.fill(max_it)
+            glitched = numpy.zeros(len(deltas), bool)
+            index = numpy.arange(len(deltas))
+            dc = numpy.array(deltas, complex)
+            dz = dc.copy() if julia else numpy.zeros(len(deltas), complex)
+            for i in range(0, max_it):
+                if not index.size:
+                    break
+                if i >= len(orbit):
+                    glitched[index] = True
+                    break
+                z = orbit[i] + dz
+                values = abs(z * z) if julia else abs(z)
+                escaped = values > 4
+                wrong = ~escaped & (abs(z) < GLITCH_TOLERANCE * abs(orbit[i]))
+                done = escaped | wrong
+                if done.any():
+                    if self.smooth:
+                        counts[index[escaped]] = numpy.maximum(
+                            _smooth(i, values[escaped], 2, numpy.log), i)
+                    else:
+                        counts[index[escaped]] = i
+                    glitched[index[wrong]] = True
+                    remaining = ~done
+                    dz = dz[remaining]
+                    dc = dc[remaining]
+                    index = index[remaining]
+                dz = (2 * orbit[i] + dz) * dz
+                if not julia:
+                    dz += dc
+            return counts, list(numpy.flatnonzero(glitched))
+        counts = []
+        glitched = []
+        for n, delta in enumerate(deltas):
+            if julia:
+                dz, dc = delta, 0
+            else:
+                dz, dc = 0j, delta
+            count = max_it
+            for i in range(0, max_it):
+                if i >= len(orbit):
+                    glitched.append(n)
+                    break
+                z = orbit[i] + dz
+                value = abs(z * z) if julia else abs(z)
+                if value > 4:
+                    if self.smooth:
+                        count = max(_smooth(i, value, 2), i)
+                    else:
+                        count = i
+                    break
+                if abs(z) < GLITCH_TOLERANCE * abs(orbit[i]):
+                    glitched.append(n)
+                    break
+                dz = (2 * orbit[i] + dz) * dz + dc
+            counts.append(count)
+        return counts, glitched
+
+    def __choose(self, kind, params, minimun, maximun, width, height):
+        """
+        Returns the cheapest precision able to tell apart the pixels of a
+        view, see `AUTO_PRECISIONS`, from their spacing ((maximun - minimun) /
+        width or height) relative to the size of the coordinates. Views too
+        deep for floats of Julia sets whose exponent is not an integer raise
+        an Exception. The precision is kept in `chosen_precision`.
+        """
+        origin, step, digits = _view(minimun, maximun, width, height)
+        size = max([abs(value) for value in
+            _coordinates(minimun) + _coordinates(maximun)] + [1])
+        spacing = float(min(abs(step[0]), abs(step[1])) / size)
+        exp = params[1] if kind == 'julia' else 2
+        for limit, precision in AUTO_PRECISIONS:
+            if precision == 'single' and self.engine != 'numpy':
+                continue
+            if precision == 'perturbation' and exp != 2:
+                continue
+            if precision == 'fixed' and (not isinstance(exp, numbers.Integral)
+                    or exp < 2):
+                continue
+            if spacing >= limit:
+                return precision
+        raise Exception("""Value not valid
+                    exp has to be an integer greater than 1 for a pixel
+                    spacing of %g, too small for floats""" % spacing)
+
+    def __prepare(self, kind, params, minimun, maximun, width, height, max_it):
+        """
+        Returns the instance which calculates the blocks (a copy with the
+        chosen precision for 'auto'), the real and imaginary parts of the
+        pixels (their differences with the reference pixel for
+        'perturbation') and what is needed to calculate them that is not in
+        the axes (None except for 'perturbation').
+        """
+        precision = self.precision
+        if precision == 'auto':
+            precision = self.__choose(kind, params, minimun, maximun,
+                    width, height)
+        self.chosen_precision = precision
+        fractals = self
+        if precision != self.precision:
+            fractals = copy.copy(self)
+            fractals.precision = precision
+        if precision in ('single', 'double'):
+            minimun = _complex(minimun)
+            maximun = _complex(maximun)
+            reals = self.__axis(minimun.real,
+                    self.__increment(width, minimun.real, maximun.real), width)
+            imags = self.__axis(minimun.imag,
+                    self.__increment(height, minimun.imag, maximun.imag),
+                    height)
+            return fractals, reals, imags, None
+        origin, step, digits = _view(minimun, maximun, width, height)
+        if precision in ('double-double', 'fixed'):
+            exp = params[1] if kind == 'julia' else 2
+            if not isinstance(exp, numbers.Integral) or exp < 2:
+                raise Exception("""Value not valid
+                    exp has to be an integer greater than 1 for the
+                    %s precision""" % precision)
+        if precision == 'fixed':
+            bits = _digits_bits(digits)
+            with localcontext() as ctx:
+                ctx.prec = digits
+                reals = [_fixed(origin[0] + i * step[0], bits)
+                    for i in range(width)]
+                imags = [_fixed(origin[1] + i * step[1], bits)
+                    for i in range(height)]
+            return fractals, reals, imags, {'bits': bits}
+        if precision == 'double-double':
+            with localcontext() as ctx:
+                ctx.prec = max(digits, 34)
+                reals = [_double_double(origin[0] + i * step[0])
+                    for i in range(width)]
+                imags = [_double_double(origin[1] + i * step[1])
+                    for i in range(height)]
+            return fractals, reals, imags, None
+        if kind == 'julia' and params[1] != 2:
+            raise Exception("""Value not valid
+                    exp has to be 2 for the perturbation precision""")
+        x, y = width // 2, height // 2
+        # Only the reference pixel goes in the blocks, each process
+        # calculates its orbit once (see `_cached_orbit`)
+        context = {'origin': origin, 'step': step, 'digits': digits,
+                'reference': (x, y)}
+        reals = [(i - x) * float(step[0]) for i in range(width)]
+        imags = [(i - y) * float(step[1]) for i in range(height)]
+        return fractals, reals, imags, context
+
+    def __mirrors(self, kind, params, reals, imags):
+        """
+        Returns the rows which are the mirror image of a previous one, as a
+        dict whose values are those previous rows, and the pairs of columns
+        (of a row and of its mirror image) whose pixels are copied. The other
+        columns are calculated. The Mandelbrot set is symmetric about the real
+        axis, and the Julia sets of exponent 2 about the origin (z and -z have
+        the same orbit after the first iteration), which halves the work for
+        the usual views. The mirrored coordinates only differ from the axes in
+        rounding errors, so a few pixels in the boundary of the set can get
+        other values. It is used by `mandelbrot`, `julia` and the tiles for
+        the 'single' and 'double' precisions.
+        """
+        columns = [(x, x) for x in range(len(reals))]
+        if kind == 'julia':
+            if params[1] != 2:
+                return {}, []
+            columns = [(x, source)
+                for x, source in enumerate(_opposites(reals))
+                if source is not None]
+        if not columns:
+            return {}, []
+        return dict((row, source)
+                for row, source in enumerate(_opposites(imags))
+                if source is not None and source < row), columns
+
+    def __render(self, kind, params, minimun, maximun, width, height, max_it):
+        """
+        Get the table of the `kind` fractal, calculated by `num_procs`
+        processes.
+        """
+        fractals, reals, imags, context = self.__prepare(kind, params,
+                minimun, maximun, width, height, max_it)
+
+        # Create the image as a table of c_double (or integers if compact)
+        Image = (self.__cell_type(max_it) * width) * height
+        image = Image()
+
+        # The rows which are the mirror image of previous ones are copied
+        # (except the columns without mirror image), so the pieces of the
+        # image that are calculated are the other rows and those columns
+        mirrors, columns = {}, []
+        if self.symmetry and fractals.precision in ('single', 'double'):
+            mirrors, columns = self.__mirrors(kind, params, reals, imags)
+        copied = set(x for x, source in columns)
+        pieces = ([(start, end, 0, width) for start, end in
+                _runs([row not in mirrors for row in range(height)])] +
+            [(start, end, begin, right) for start, end in
+                _runs([row in mirrors for row in range(height)])
+                for begin, right in
+                _runs([x not in copied for x in range(width)])])
+
+        # Blocks of `chunk_size` rows (or tiles if subdivide), the processes
+        # take the next one when they finish the previous, so the ones with
+        # cheap blocks just calculate more of them. They are generated (and
+        # calculated) one by one, so only a few are in memory at a time.
+        if self.subdivide:
+            blocks = ((fractals, kind, params,
+                reals[left:min(left + self.tile_size, right)],
+                imags[first:min(first + self.tile_size, end)], max_it, first,
+                left, context)
+                for start, end, begin, right in pieces
+                for first in range(start, end, self.tile_size)
+                for left in range(begin, right, self.tile_size))
+        else:
+            blocks = ((fractals, kind, params, reals[left:right],
+                imags[first:min(first + self.chunk_size, end)], max_it, first,
+                left, context) for start, end, left, right in pieces
+                for first in range(start, end, self.chunk_size))
 
         # Use processes to do calculations
         if self.num_procs == 1:
-            calculate(image)
+            results = itertools.imap(_calculate, blocks)
         else:
-            processes = []
-            for id in range(self.num_procs):
-                processes.append(Process(target=calculate,
-                    args=(image, self.num_procs, id)))
-                processes[-1].start()
-            for p in processes:
-                if p.is_alive():
-                    p.join()
-
-        # Get the image values as a double list
-        return map(list, list(image))
+            results = self.__get_pool().imap_unordered(_calculate, blocks)
+        if numpy is not None:
+            view = numpy.ctypeslib.as_array(image)
+        for first, left, rows, histogram in results:
+            if histogram is not None:
+                self.__add_histogram(histogram, max_it)
+            if numpy is not None:
+                view[first:first + len(rows), left:left + len(rows[0])] = rows
+            else:
+                for w, row in enumerate(rows):
+                    image[first + w][left:left + len(row)] = row
+        if mirrors:
+            rows = sorted(mirrors)
+            targets = [x for x, source in columns]
+            sources = [source for x, source in columns]
+            if numpy is not None:
+                copies = view[numpy.ix_([mirrors[row] for row in rows],
+                    sources)]
+                view[numpy.ix_(rows, targets)] = copies
+            else:
+                copies = []
+                for row in rows:
+                    copies.append([image[mirrors[row]][x] for x in sources])
+                    for x, value in zip(targets, copies[-1]):
+                        image[row][x] = value
+            if self.collect_histogram:
+                self.__add_histogram(_histogram(copies, max_it), max_it)
+
+        if self.output == 'numpy':
+            return view
+        if self.output == 'list':
+            # Get the image values as a double list
+            return map(list, list(image))
+        return image
+
+    def __stream(self, kind, params, minimun, maximun, width, height, max_it):
+        """
+        Returns a generator of the rows of the `kind` fractal, in order. Only
+        a few blocks of rows (two for each process) are calculated in advance,
+        so the whole table is never in memory. The precision is chosen here,
+        before the first row is asked for.
+        """
+        fractals, reals, imags, context = self.__prepare(kind, params,
+                minimun, maximun, width, height, max_it)
+        Row = self.__cell_type(max_it) * width
+
+        # Blocks of rows that are calculated as a whole (tiles as wide as the
+        # image if subdivide)
+        size = self.tile_size if self.subdivide else self.chunk_size
+        blocks = ((fractals, kind, params, reals, imags[first:first + size],
+            max_it, first, 0, context) for first in range(0, height, size))
+
+        if self.num_procs == 1:
+            results = (_calculate(block) for block in blocks)
+        else:
+            results = self.__ahead(blocks, 2 * self.num_procs)
+        return self.__rows(results, Row, max_it)
+
+    def __rows(self, results, Row, max_it):
+        """
+        Generator of the rows of the blocks in `results` (in order) as
+        `output` requires, `Row` is the ctypes type of a row of the table
+        """
+        for first, left, rows, histogram in results:
+            if histogram is not None:
+                self.__add_histogram(histogram, max_it)
+            for row in rows:
+                if self.output == 'numpy':
+                    yield numpy.asarray(row, Row._type_)
+                elif self.output == 'list':
+                    yield list(row)
+                elif numpy is not None:
+                    table_row = Row()
+                    numpy.ctypeslib.as_array(table_row)[:] = row
+                    yield table_row
+                else:
+                    yield Row(*row)
+
+    def __ahead(self, blocks, window):
+        """
+        Generator of the results of the blocks in order, keeping at most
+        `window` blocks sent to the pool
+        """
+        pool = self.__get_pool()
+        pending = deque()
+        for block in blocks:
+            pending.append(pool.apply_async(_calculate, (block,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def mandelbrot(self, minimun, maximun, width, height, max_it):
+        """
+        Get a table representation of a Mandelbrot set (for `max_it` iterations)
+        whose size is `width` x `height`.
+        `minimun` and `maximun` are, respectively, the minimun and maximun complex
+        numbers that are represented (minimun in the bottom-left and maximun in
+        the top-right). For the precisions beyond 'double' they can be given
+        as pairs (real, imaginary) of strings, Decimals or Fractions, to be
+        more precise than a complex, and `periodicity` and `subdivide` are
+        ignored.
+        The result depends on `output`: 'table' returns the ctypes table where
+        the values are stored (``table[row][column]``), 'numpy' a numpy array
+        which shares its memory and 'list' a copy as a list of lists.
+        """
+        return self.__render('mandelbrot', (), minimun, maximun,
+                width, height, max_it)
 
     def julia(self, c, exp, minimun, maximun, width, height, max_it):
         """
@@ -119,47 +1030,436 @@ class Fractals:
         numbers that are represented (minimun in the bottom-left and maximun in
         the top-right)
         """
-        inc_real = self.__increment(width, minimun.real, maximun.real)
-        inc_imag = self.__increment(height, minimun.imag, maximun.imag)
+        return self.__render('julia', (c, exp), minimun, maximun,
+                width, height, max_it)
 
-        #Use this function to calculate some colums with each process
-        def calculate(image, num_procs=1, id_proc=0):
-            """
-            Each process has to calculate some colums, for example if there is
-            two process:
-            proc 0 will calculate colums 0, 2, 4, ...
-            proc 1 will calculate colums 1, 3, 5, ...
-            """
-            ch = minimun.imag
-            cw = minimun.real
-            ch += id_proc*inc_imag
-            for w in range(id_proc, height, num_procs):
-                for h in range(width):
-                    image[w][h] = self.in_julia(complex(cw, ch), c, exp, max_it)
-                    cw += inc_real
-                ch += num_procs * inc_imag
-                cw = minimun.real
-
-        # Create the image as a c_double table
-        Image = (c_double * width) * height
-        # Use shared memory to store the image
-        image = Value(Image)
 
-        # Use processes to do calculations
-        if self.num_procs == 1:
-            calculate(image)
+    def mandelbrot_rows(self, minimun, maximun, width, height, max_it):
+        """
+        Same as `mandelbrot` but returns a generator of the rows of the table,
+        which are calculated while they are consumed (they can be written to
+        a PNG file as soon as they are ready, see `png.Writer.write`).
+        """
+        return self.__stream('mandelbrot', (), minimun, maximun,
+                width, height, max_it)
+
+    def julia_rows(self, c, exp, minimun, maximun, width, height, max_it):
+        """
+        Same as `julia` but returns a generator of the rows of the table, see
+        `mandelbrot_rows`.
+        """
+        return self.__stream('julia', (c, exp), minimun, maximun,
+                width, height, max_it)
+
+    def __tile_bounds(self, minimun, maximun, zoom, tile_x, tile_y):
+        """
+        Returns the minimun and maximun complex numbers of a tile
+        """
+        tiles = 2 ** zoom
+        if not 0 <= tile_x < tiles or not 0 <= tile_y < tiles:
+            raise Exception("""Value not valid
+                    tile_x and tile_y have to be in [0, ..., %d] for zoom %d"""
+                    % (tiles - 1, zoom))
+        if isinstance(minimun, (tuple, list)) or isinstance(maximun,
+                (tuple, list)):
+            # Precise coordinates give exact tiles
+            (min_real, min_imag), (max_real, max_imag) = (
+                map(Fraction, _parts(minimun)), map(Fraction, _parts(maximun)))
+            tile_real = (max_real - min_real) / tiles
+            tile_imag = (max_imag - min_imag) / tiles
+            tile_min = (min_real + tile_x * tile_real,
+                    min_imag + tile_y * tile_imag)
+            return tile_min, (tile_min[0] + tile_real, tile_min[1] + tile_imag)
+        tile_real = (maximun.real - minimun.real) / tiles
+        tile_imag = (maximun.imag - minimun.imag) / tiles
+        tile_min = complex(minimun.real + tile_x * tile_real,
+                minimun.imag + tile_y * tile_imag)
+        return tile_min, tile_min + complex(tile_real, tile_imag)
+
+    def mandelbrot_tile(self, minimun, maximun, zoom, tile_x, tile_y,
+            tile_size, max_it):
+        """
+        Get a table representation (`tile_size` x `tile_size`) of a tile of
+        the Mandelbrot set (for `max_it` iterations).
+        `minimun` and `maximun` define the whole view as in `mandelbrot`, at
+        zoom level `zoom` it is divided in 2^zoom x 2^zoom tiles, `tile_x` and
+        `tile_y` are the column and row of the tile (starting from `minimun`).
+        """
+        tile_min, tile_max = self.__tile_bounds(minimun, maximun, zoom,
+                tile_x, tile_y)
+        return self.mandelbrot(tile_min, tile_max, tile_size, tile_size,
+                max_it)
+
+    def julia_tile(self, c, exp, minimun, maximun, zoom, tile_x, tile_y,
+            tile_size, max_it):
+        """
+        Get a table representation (`tile_size` x `tile_size`) of a tile of
+        a Julia set, see `julia` and `mandelbrot_tile`.
+        """
+        tile_min, tile_max = self.__tile_bounds(minimun, maximun, zoom,
+                tile_x, tile_y)
+        return self.julia(c, exp, tile_min, tile_max, tile_size, tile_size,
+                max_it)
+
+def _calculate(block):
+    """
+    Calculate a block of rows (or a tile), it is used by the processes of the
+    pool. Returns the first row and column of the block, the block itself and
+    its histogram (None if it is not collected).
+    """
+    fractals, kind, params, reals, imags, max_it, first, left, context = block
+    if fractals.precision == 'perturbation':
+        rows = fractals.calculate_perturbation(kind, params, reals, imags,
+                max_it, context, first, left)
+    elif fractals.precision == 'fixed':
+        rows = fractals.calculate_fixed(kind, params, reals, imags, max_it,
+                context['bits'])
+    elif fractals.subdivide and fractals.precision in ('single', 'double'):
+        rows = fractals.calculate_rect(kind, params, reals, imags, max_it)
+    else:
+        rows = fractals.calculate_rows(kind, params, reals, imags, max_it)
+    histogram = None
+    if fractals.collect_histogram:
+        histogram = _histogram(rows, max_it)
+    return first, left, rows, histogram
+
+def _histogram(rows, max_it):
+    """
+    Returns how many values of `rows` there are of each iteration count
+    """
+    if numpy is not None and isinstance(rows, numpy.ndarray):
+        return list(numpy.bincount(rows.astype(numpy.intp).ravel(),
+            minlength=max_it + 1))
+    histogram = [0] * (max_it + 1)
+    for row in rows:
+        for p in row:
+            histogram[int(p)] += 1
+    return histogram
+
+def _runs(flags):
+    """
+    Returns the ranges [start, end) of consecutive positions where `flags`
+    is true
+    """
+    runs = []
+    for position, flag in enumerate(flags):
+        if not flag:
+            continue
+        if runs and runs[-1][1] == position:
+            runs[-1][1] += 1
         else:
-            processes = []
-            for id in range(self.num_procs):
-                processes.append(Process(target=calculate,
-                    args=(image, self.num_procs, id)))
-                processes[-1].start()
-            for p in processes:
-                if p.is_alive():
-                    p.join()
+            runs.append([position, position + 1])
+    return runs
+
+def _opposites(axis):
+    """
+    Returns, for each value of an evenly spaced `axis`, the position of the
+    value which is its opposite (but for rounding errors), or None
+    """
+    if len(axis) < 2 or axis[-1] == axis[0]:
+        return [None] * len(axis)
+    step = (axis[-1] - axis[0]) / (len(axis) - 1)
+    opposites = []
+    for value in axis:
+        position = int(round((-value - axis[0]) / step))
+        if (0 <= position < len(axis) and
+                abs(axis[position] + value) <= abs(step) * 1e-6):
+            opposites.append(position)
+        else:
+            opposites.append(None)
+    return opposites
+
+def _smooth(i, value, exp, log=math.log):
+    """
+    Returns the fractional count of a point which escapes after `i`
+    iterations with `value` (its |z| or |z^2| for Julia sets, which are
+    compared with 4) for z' = z^exp + c, from how far from the escape radius
+    the value is. It can be below `i` when the value is far, so the callers
+    clamp it. `log` can be numpy.log for arrays.
+    """
+    return i + 1 - log(log(value) / math.log(4)) / math.log(abs(exp))
+
+def _power(z, exp):
+    """
+    Returns z**exp for a numpy array `z`. Positive integer exponents are
+    calculated as python does for complex numbers (binary exponentiation),
+    so the values are exactly the same as the ones of `in_julia`.
+    """
+    if not isinstance(exp, numbers.Integral) or exp < 1 or exp > 100:
+        return z ** exp
+    exp = int(exp)
+    result = None
+    mask = 1
+    while exp >= mask:
+        if exp & mask:
+            result = z if result is None else result * z
+        mask <<= 1
+        if exp >= mask:
+            z = z * z
+    return result
+
+def _double_double(value):
+    """
+    Returns a Decimal `value` as a pair of floats whose sum is `value` with
+    about 32 significant digits
+    """
+    high = float(value)
+    return high, float(value - Decimal(high))
+
+def _two_sum(a, b):
+    """
+    Returns a + b as a float and the rounding error of that float
+    """
+    s = a + b
+    v = s - a
+    return s, (a - (s - v)) + (b - v)
+
+def _quick_two_sum(a, b):
+    """
+    Same as `_two_sum` when |a| >= |b|
+    """
+    s = a + b
+    return s, b - (s - a)
+
+def _two_prod(a, b):
+    """
+    Returns a * b as a float and the rounding error of that float, splitting
+    the factors in halves of 26 bits (Dekker's algorithm)
+    """
+    p = a * b
+    t = 134217729.0 * a
+    a_high = t - (t - a)
+    a_low = a - a_high
+    t = 134217729.0 * b
+    b_high = t - (t - b)
+    b_low = b - b_high
+    return p, ((a_high * b_high - p) + a_high * b_low + a_low * b_high +
+            a_low * b_low)
+
+def _dd_add(a, b):
+    """
+    Returns the sum of two double-double numbers (pairs of high and low
+    parts, which can be floats or numpy arrays)
+    """
+    s, e = _two_sum(a[0], b[0])
+    t, f = _two_sum(a[1], b[1])
+    s, e = _quick_two_sum(s, e + t)
+    return _quick_two_sum(s, e + f)
+
+def _dd_mul(a, b):
+    """
+    Returns the product of two double-double numbers
+    """
+    p, e = _two_prod(a[0], b[0])
+    return _quick_two_sum(p, e + (a[0] * b[1] + a[1] * b[0]))
+
+def _dd_complex_mul(z, w):
+    """
+    Returns the product of two complex numbers whose real and imaginary parts
+    are double-double numbers
+    """
+    real = _dd_add(_dd_mul(z[0], w[0]), _dd_mul(z[1], (-w[1][0], -w[1][1])))
+    imag = _dd_add(_dd_mul(z[0], w[1]), _dd_mul(z[1], w[0]))
+    return real, imag
+
+def _dd_iterate(z, c, exp):
+    """
+    Returns z^exp + c for complex numbers of double-double parts, the power
+    is calculated by binary exponentiation
+    """
+    result = None
+    while exp:
+        if exp & 1:
+            result = z if result is None else _dd_complex_mul(result, z)
+        exp >>= 1
+        if exp:
+            z = _dd_complex_mul(z, z)
+    return _dd_add(result[0], c[0]), _dd_add(result[1], c[1])
+
+def _dd_take(z, keep):
+    """
+    Returns the elements `keep` (an index or mask) of a complex number of
+    double-double parts made of numpy arrays
+    """
+    return tuple((high[keep], low[keep]) for high, low in z)
+
+def _parts(value):
+    """
+    Returns the real and imaginary parts of `value`, a complex number or a
+    pair of real and imaginary parts (numbers, strings, Decimals or
+    Fractions)
+    """
+    if isinstance(value, (tuple, list)):
+        real, imag = value
+        return real, imag
+    return complex(value).real, complex(value).imag
+
+def _complex(value):
+    """
+    Returns `value` (see `_parts`) as a complex number
+    """
+    if isinstance(value, (tuple, list)):
+        return complex(float(value[0]), float(value[1]))
+    return value
+
+def _decimal(value):
+    """
+    Returns a number, string or Fraction as a Decimal. Fractions are divided
+    with enough digits to tell them apart from the ones with similar terms.
+    """
+    if isinstance(value, Fraction):
+        with localcontext() as ctx:
+            ctx.prec = (len(str(abs(value.numerator))) +
+                len(str(value.denominator)) + 20)
+            return Decimal(value.numerator) / value.denominator
+    return Decimal(value)
+
+def _coordinates(value):
+    """
+    Returns the real and imaginary parts of `value` (see `_parts`) as
+    Decimals
+    """
+    real, imag = _parts(value)
+    return _decimal(real), _decimal(imag)
+
+def _view(minimun, maximun, width, height):
+    """
+    Returns the origin (the bottom-left pixel) and the pixel spacing, as pairs
+    of Decimals, of a view of `width` x `height` pixels, and the digits needed
+    to calculate the pixels precisely enough.
+    """
+    min_real, min_imag = _coordinates(minimun)
+    max_real, max_imag = _coordinates(maximun)
+    with localcontext() as ctx:
+        ctx.prec = 34
+        step = ((max_real - min_real) / width, (max_imag - min_imag) / height)
+    # The spacing has to be represented with 10 digits more at least
+    magnitude = max(min_real.adjusted(), min_imag.adjusted(),
+            max_real.adjusted(), max_imag.adjusted(), 0)
+    digits = max(20, magnitude - min(step[0].adjusted(), step[1].adjusted())
+            + 10)
+    return (min_real, min_imag), step, digits
+
+def _pixel(origin, step, x, y, digits):
+    """
+    Returns the coordinates of the pixel of column `x` and row `y` of a view
+    (see `_view`) as a pair of Decimals
+    """
+    with localcontext() as ctx:
+        ctx.prec = digits
+        return origin[0] + x * step[0], origin[1] + y * step[1]
+
+def _reference_orbit(kind, params, point, max_it, digits):
+    """
+    Returns the orbit of `point` (a pair of Decimals) for the `kind` fractal,
+    calculated in fixed point with the bits of `digits` significant digits
+    and rounded to complex numbers. It ends when the point escapes or after
+    `max_it` values.
+    """
+    bits = _digits_bits(digits)
+    orbit = []
+    if kind == 'mandelbrot':
+        _fixed_iterate((0, 0), _fixed_pair(point, bits), 2, max_it, bits,
+                False, orbit)
+    else:
+        _fixed_iterate(_fixed_pair(point, bits),
+                _fixed_pair(params[0], bits), 2, max_it, bits, True, orbit)
+    return orbit
+
+def _cached_orbit(*args):
+    """
+    Same as `_reference_orbit`, but the last orbit calculated by the process
+    is kept, so it is calculated once for all the blocks of a render
+    """
+    if args not in _orbits:
+        _orbits.clear()
+        _orbits[args] = _reference_orbit(*args)
+    return _orbits[args]
+
+# The last reference orbit of `_cached_orbit`, by its arguments
+_orbits = {}
+
+def _digits_bits(digits):
+    """
+    Returns the bits of a fixed point number as precise as `digits` digits
+    """
+    return int(math.ceil(digits * math.log(10, 2)))
 
-        # Get the image values as a double list
-        return map(list, list(image))
+def _fixed_bits(*values):
+    """
+    Returns the bits needed to represent the parts of `values` (see `_parts`)
+    in fixed point: 32 bits more than the largest denominator they have as
+    Fractions, and 64 at least
+    """
+    denominators = [Fraction(part).denominator
+        for value in values for part in _parts(value)]
+    return max(64, max(d.bit_length() for d in denominators) + 32)
 
+def _fixed(value, bits):
+    """
+    Returns a number, string, Decimal or Fraction as an integer scaled by
+    2^`bits` (rounded down)
+    """
+    value = Fraction(value)
+    return (value.numerator << bits) // value.denominator
 
+def _fixed_pair(value, bits):
+    """
+    Returns the real and imaginary parts of `value` (see `_parts`) in fixed
+    point
+    """
+    real, imag = _parts(value)
+    return _fixed(real, bits), _fixed(imag, bits)
 
+def _fixed_float(value, bits):
+    """
+    Returns a fixed point number as a float
+    """
+    if bits > 60:
+        return math.ldexp(value >> (bits - 60), -60)
+    return math.ldexp(value, -bits)
+
+def _fixed_in_main_bulbs(c, bits):
+    """
+    Same as `Fractals.in_main_bulbs` for a fixed point `c`
+    """
+    real, imag = c
+    x = real - (1 << bits - 2)
+    y2 = imag * imag >> bits
+    q = (x * x >> bits) + y2
+    if q * (q + x) >> bits < y2 >> 2:
+        return True
+    x = real + (1 << bits)
+    return (x * x >> bits) + y2 < 1 << bits - 4
+
+def _fixed_iterate(z, c, exp, max_it, bits, julia, orbit=None):
+    """
+    Iterate z' = z^exp + c in fixed point (pairs of integers scaled by
+    2^`bits`) for a positive integer `exp`. Returns the number of iterations
+    after which |z| > 4 (|z^2| > 4 for Julia sets, as `in_julia`), or
+    `max_it`, and |z|^2 in fixed point at that moment (None if it does not
+    escape). The values of z are
+    appended to `orbit` as complex numbers if it is given.
+    """
+    real, imag = z
+    c_real, c_imag = c
+    limit = (4 if julia else 16) << bits
+    for i in range(0, max_it):
+        real2 = real * real >> bits
+        imag2 = imag * imag >> bits
+        if orbit is not None:
+            orbit.append(complex(_fixed_float(real, bits),
+                _fixed_float(imag, bits)))
+        if real2 + imag2 > limit:
+            return i, real2 + imag2
+        if exp == 2:
+            real, imag = (real2 - imag2 + c_real,
+                    (real * imag >> bits - 1) + c_imag)
+        else:
+            power_real, power_imag = real, imag
+            for n in range(1, exp):
+                power_real, power_imag = (
+                    power_real * real - power_imag * imag >> bits,
+                    power_real * imag + power_imag * real >> bits)
+            real, imag = power_real + c_real, power_imag + c_imag
+    return max_it, None
@@ -177,10 +177,17 @@ import math
 import operator
 import struct
 import sys
+import tempfile
 import zlib
 # http://www.python.org/doc/2.4.4/lib/module-warnings.html
 import warnings
 
+# numpy is optional, it speeds up the scanline filters.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 __all__ = ['Reader', 'Writer', 'write_chunks']
 
@@ -319,7 +326,9 @@ class Writer:
                  planes=None,
                  colormap=None,
                  maxval=None,
-                 chunk_limit=2**20):
+                 chunk_limit=2**20,
+                 compression_threads=None,
+                 filter_type=None):
         """
         Create a PNG encoder object.
 
@@ -349,6 +358,10 @@ class Writer:
           Create an interlaced image.
         chunk_limit
           Write multiple ``IDAT`` chunks to save memory.
+        compression_threads
+          Compress the image data using several threads.
+        filter_type
+          Scanline filter type (0 to 4), or ``'adaptive'``.
 
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
@@ -429,12 +442,29 @@ class Writer:
         
         .. note ::
         
-          Enabling the `interlace` option requires the entire image
-          to be processed in working memory.
+          With the `interlace` option, :meth:`write` stores the
+          reduced images in temporary files, as the first one can only
+          be written when all the rows have been supplied.
 
         `chunk_limit` is used to limit the amount of memory used whilst
         compressing the image.  In order to avoid using large amounts of
         memory, multiple ``IDAT`` chunks may be created.
+
+        If `compression_threads` is specified, the image data is split
+        in segments of about `chunk_limit` bytes which are compressed
+        concurrently by that many threads (``zlib`` releases the
+        interpreter lock while compressing) and joined in a single
+        ``zlib`` stream.  Segments do not share their history, so the
+        result is slightly bigger than without threads.
+
+        `filter_type` selects the PNG filter applied to every scanline
+        before compressing it: 0 (None, the default), 1 (Sub), 2 (Up),
+        3 (Average) or 4 (Paeth).  With ``'adaptive'`` each scanline
+        uses the filter that gives the minimum sum of absolute
+        differences (the heuristic recommended by the PNG
+        specification).  Smooth images usually compress better with a
+        filter.  The first scanline of each reduced image of an
+        interlaced image is filtered without a previous scanline.
         """
 
         # At the moment the `planes` argument is ignored;
@@ -560,6 +590,9 @@ class Writer:
         if bitdepth > 8 and palette:
             raise ValueError(
                 "bit depth must be 8 or less for images with palette")
+        if filter_type not in (None, 0, 1, 2, 3, 4, 'adaptive'):
+            raise ValueError(
+                "filter_type must be 0, 1, 2, 3, 4 or 'adaptive'")
 
         transparent = check_color(transparent, 'transparent')
         background = check_color(background, 'background')
@@ -578,6 +611,8 @@ class Writer:
         self.bitdepth = int(bitdepth)
         self.compression = compression
         self.chunk_limit = chunk_limit
+        self.compression_threads = compression_threads
+        self.filter_type = filter_type
         self.interlace = bool(interlace)
         self.palette = check_palette(palette)
 
@@ -619,13 +654,12 @@ class Writer:
         
         .. note ::
 
-          Interlacing will require the entire image to be in working memory.
+          Interlacing stores the reduced images in temporary files (see
+          :meth:`spill_scanlines_interlace`), not in working memory.
         """
 
         if self.interlace:
-            fmt = 'BH'[self.bitdepth > 8]
-            a = array(fmt, itertools.chain(*rows))
-            return self.write_array(outfile, a)
+            self.write_passes(outfile, self.spill_scanlines_interlace(rows))
         else:
             nrows = self.write_passes(outfile, rows)
             if nrows != self.height:
@@ -706,7 +740,10 @@ class Writer:
                             struct.pack("!3H", *self.background))
 
         # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
+        if self.compression_threads:
+            compressor = ParallelCompressor(self.compression,
+                                            self.compression_threads)
+        elif self.compression is not None:
             compressor = zlib.compressobj(self.compression)
         else:
             compressor = zlib.compressobj()
@@ -718,33 +755,71 @@ class Writer:
         if self.bitdepth == 8 or packed:
             extend = data.extend
         elif self.bitdepth == 16:
-            # Decompose into bytes
+            # Decompose into bytes, swapping them on little endian
+            # machines (PNG is big endian).
+            swap = sys.byteorder == 'little'
             def extend(sl):
-                fmt = '!%dH' % len(sl)
-                data.extend(array('B', struct.pack(fmt, *sl)))
+                if numpy is not None and isinstance(sl, numpy.ndarray):
+                    data.fromstring(numpy.asarray(sl, '>u2').tostring())
+                    return
+                if isinstance(sl, array) and sl.typecode == 'H':
+                    # Copy the whole row, not element by element
+                    a = array('H')
+                    a.fromstring(tostring(sl))
+                    if swap:
+                        a.byteswap()
+                    data.fromstring(tostring(a))
+                    return
+                data.fromstring(struct.pack('!%dH' % len(sl), *sl))
         else:
             # Pack into bytes
             assert self.bitdepth < 8
             # samples per byte
             spb = int(8/self.bitdepth)
+            # The byte of every spb-tuple of samples.
+            pack = {}
+            for e in itertools.product(range(2**self.bitdepth), repeat=spb):
+                pack[e] = reduce(lambda x,y: (x << self.bitdepth) + y, e)
             def extend(sl):
                 a = array('B', sl)
                 # Adding padding bytes so we can group into a whole
                 # number of spb-tuples.
-                l = float(len(a))
-                extra = math.ceil(l / float(spb))*spb - l
-                a.extend([0]*int(extra))
+                extra = -len(a) % spb
+                a.extend([0]*extra)
                 # Pack into bytes
-                l = group(a, spb)
-                l = map(lambda e: reduce(lambda x,y:
-                                           (x << self.bitdepth) + y, e), l)
-                data.extend(l)
+                data.extend([pack[e] for e in group(a, spb)])
         if self.rescale:
             oldextend = extend
             factor = \
               float(2**self.rescale[1]-1) / float(2**self.rescale[0]-1)
+            # The rescaled value of every source value.
+            scale = [int(round(factor*x)) for x in range(2**self.rescale[0])]
             def extend(sl):
-                oldextend(map(lambda x: int(round(factor*x)), sl))
+                oldextend([scale[x] for x in sl])
+
+        # Filter the scanline that starts (with its filter type byte)
+        # at `start` in `data`, after it has been extended.
+        if self.filter_type:
+            # Filter offset, in bytes
+            fo = max(1, (self.bitdepth * self.planes) // 8)
+            # Rows that start a pass (they have no previous scanline)
+            starts = self.pass_starts()
+            # The previous scanline, unfiltered
+            previous = [None]
+            def filter_row(i, start):
+                line = data[start+1:]
+                if i in starts:
+                    previous[0] = None
+                if self.filter_type == 'adaptive':
+                    filtered = adaptive_filter(line, fo, previous[0])
+                else:
+                    filtered = filter_scanline(self.filter_type, line, fo,
+                                               previous[0])
+                data[start:] = filtered
+                previous[0] = line
+        else:
+            def filter_row(i, start):
+                pass
 
         # Build the first row, testing mostly to see if we need to
         # changed the extend function to cope with NumPy integer types
@@ -755,6 +830,7 @@ class Writer:
         del rows
 
         # First row's filter type.
+        start = len(data)
         data.append(0)
         # :todo: Certain exceptions in the call to ``.next()`` or the
         # following try would indicate no row data supplied.
@@ -773,15 +849,17 @@ class Writer:
             extend = wrapmapint(extend)
             del wrapmapint
             extend(row)
+        filter_row(i, start)
 
         for i,row in enumrows:
-            # Add "None" filter type.  Currently, it's essential that
-            # this filter type be used for every scanline as we do not
-            # mark the first row of a reduced pass image; that means we
-            # could accidentally compute the wrong filtered scanline if
-            # we used "up", "average", or "paeth" on such a line.
+            # Add "None" filter type, `filter_row` replaces it when
+            # filtering.  It knows which rows start a reduced pass
+            # image (see :meth:`pass_starts`), where "up", "average" and
+            # "paeth" must not use the previous scanline.
+            start = len(data)
             data.append(0)
             extend(row)
+            filter_row(i, start)
             if len(data) > self.chunk_limit:
                 compressed = compressor.compress(tostring(data))
                 if len(compressed):
@@ -804,6 +882,23 @@ class Writer:
         write_chunk(outfile, 'IEND')
         return i+1
 
+    def pass_starts(self):
+        """Return the set of the indexes of the scanlines that start
+        a reduced image (pass) when the image is written, just ``0``
+        when the image is not interlaced.
+        """
+
+        if not self.interlace:
+            return set([0])
+        starts = set()
+        row = 0
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width or ystart >= self.height:
+                continue
+            starts.add(row)
+            row += int(math.ceil((self.height-ystart)/float(ystep)))
+        return starts
+
     def write_array(self, outfile, pixels):
         """
         Write an array in flat row flat pixel format as a PNG file on
@@ -948,6 +1043,66 @@ class Writer:
                             pixels[offset+i:end_offset:skip]
                     yield row
 
+    def spill_scanlines_interlace(self, rows):
+        """
+        Generator for interlaced scanlines from an iterable of rows in
+        boxed row flat pixel format (in the normal image order).  Each
+        reduced image (pass) is stored in a temporary file (kept in
+        memory while it is smaller than `chunk_limit` bytes) as the
+        rows are consumed, and its scanlines are read back when all the
+        rows have been consumed, so only a few rows are in working
+        memory.
+        """
+
+        # http://www.w3.org/TR/PNG/#8InterlaceMethods
+        fmt = 'BH'[self.bitdepth > 8]
+        itemsize = array(fmt).itemsize
+        # For each pass: the temporary file and the values per row.
+        passes = []
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width or ystart >= self.height:
+                passes.append((None, 0))
+                continue
+            ppr = int(math.ceil((self.width-xstart)/float(xstep)))
+            passes.append((tempfile.SpooledTemporaryFile(self.chunk_limit),
+                           ppr*self.planes))
+        nrows = 0
+        for y,row in enumerate(rows):
+            nrows += 1
+            try:
+                row = array(fmt, row)
+            except TypeError:
+                row = array(fmt, map(int, row))
+            for (xstart, ystart, xstep, ystep),(spill, row_len) in \
+                  zip(_adam7, passes):
+                if spill is None or y < ystart or (y - ystart) % ystep:
+                    continue
+                if xstep == 1:
+                    reduced = row
+                else:
+                    reduced = row[0:row_len]
+                    skip = self.planes * xstep
+                    for i in range(self.planes):
+                        reduced[i::self.planes] = \
+                            row[xstart*self.planes+i::skip]
+                spill.write(tostring(reduced))
+        if nrows != self.height:
+            raise ValueError(
+              "rows supplied (%d) does not match height (%d)" %
+              (nrows, self.height))
+        for spill, row_len in passes:
+            if spill is None:
+                continue
+            spill.seek(0)
+            while True:
+                data = spill.read(row_len * itemsize)
+                if not data:
+                    break
+                reduced = array(fmt)
+                reduced.fromstring(data)
+                yield reduced
+            spill.close()
+
 def write_chunk(outfile, tag, data=''):
     """
     Write a PNG chunk to the output file, including length and
@@ -962,6 +1117,105 @@ def write_chunk(outfile, tag, data=''):
     checksum = zlib.crc32(data, checksum)
     outfile.write(struct.pack("!i", checksum))
 
+def adler32_combine(adler1, adler2, len2):
+    """Return the Adler-32 checksum of the concatenation of two strings
+    given the checksum of each one (`adler1` and `adler2`) and the
+    length of the second one (`len2`).  Same as zlib's
+    ``adler32_combine``.
+    """
+
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + base - rem
+    return (sum1 % base) | ((sum2 % base) << 16)
+
+def _compress_segment(args):
+    """Compress a segment of a :class:`ParallelCompressor` stream.
+    Returns the raw deflate data (ending on a byte boundary), and the
+    checksum and length of the segment.
+    """
+
+    segment, level = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(segment) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data, zlib.adler32(segment) & 0xffffffff, len(segment)
+
+class ParallelCompressor:
+    """Compressor with the interface of ``zlib.compressobj`` that
+    compresses each string given to :meth:`compress` as an independent
+    segment in a pool of threads (in the style of ``pigz``).  Each
+    segment is a sequence of raw deflate blocks ending on a byte
+    boundary, so they are joined between the ``zlib`` header and an
+    empty final block followed by the combined Adler-32 checksum.
+    """
+
+    def __init__(self, level=None, threads=2):
+        from multiprocessing.pool import ThreadPool
+
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        self.level = level
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.pending = []
+        self.adler = 1
+        # http://www.ietf.org/rfc/rfc1950.txt
+        flevel = 2
+        if 0 <= level < 2:
+            flevel = 0
+        elif 2 <= level < 6:
+            flevel = 1
+        elif level > 6:
+            flevel = 3
+        cmf = 0x78
+        flg = flevel << 6
+        flg += 31 - (cmf * 256 + flg) % 31
+        self.header = struct.pack('BB', cmf, flg)
+
+    def compress(self, data):
+        """Start compressing `data` and return the compressed data of
+        the segments already finished (in order).
+        """
+
+        if not len(data):
+            return ''
+        self.pending.append(
+          self.pool.apply_async(_compress_segment, ((data, self.level),)))
+        out = []
+        while self.pending and (self.pending[0].ready() or
+                                len(self.pending) > 2*self.threads):
+            out.append(self.segment(self.pending.pop(0).get()))
+        return ''.join(out)
+
+    def segment(self, result):
+        """Return the compressed data of a finished segment, preceded by
+        the ``zlib`` header if it is the first one.
+        """
+
+        data, adler, length = result
+        if self.header:
+            data = self.header + data
+            self.header = ''
+        self.adler = adler32_combine(self.adler, adler, length)
+        return data
+
+    def flush(self):
+        """Wait for all the segments and finish the stream."""
+
+        out = [self.segment(p.get()) for p in self.pending]
+        self.pending = []
+        self.pool.close()
+        self.pool.join()
+        out.append(self.header)
+        self.header = ''
+        final = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        out.append(final.compress('') + final.flush())
+        out.append(struct.pack('!I', self.adler))
+        return ''.join(out)
+
 def write_chunks(out, chunks):
     """Create a PNG file by writing out the chunks."""
 
@@ -977,81 +1231,158 @@ def filter_scanline(type, line, fo, prev=None):
     filter offset; normally this is size of a pixel in bytes (the number
     of bytes per sample times the number of channels), but when this is
     < 1 (for bit depths < 8) then the filter offset is 1.
+
+    The whole scanline is filtered at once, using numpy if it is
+    available.
     """
 
     assert 0 <= type < 5
 
-    # The output array.  Which, pathetically, we extend one-byte at a
-    # time (fortunately this is linear).
+    # The output array.
     out = array('B', [type])
 
-    def sub():
-        ai = -fo
-        for x in line:
-            if ai >= 0:
-                x = (x - line[ai]) & 0xff
-            out.append(x)
-            ai += 1
-    def up():
-        for i,x in enumerate(line):
-            x = (x - prev[i]) & 0xff
-            out.append(x)
-    def average():
-        ai = -fo
-        for i,x in enumerate(line):
-            if ai >= 0:
-                x = (x - ((line[ai] + prev[i]) >> 1)) & 0xff
-            else:
-                x = (x - (prev[i] >> 1)) & 0xff
-            out.append(x)
-            ai += 1
-    def paeth():
-        # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
-        ai = -fo # also used for ci
-        for i,x in enumerate(line):
-            a = 0
-            b = prev[i]
-            c = 0
-
-            if ai >= 0:
-                a = line[ai]
-                c = prev[ai]
-            p = a + b - c
-            pa = abs(p - a)
-            pb = abs(p - b)
-            pc = abs(p - c)
-            if pa <= pb and pa <= pc: Pr = a
-            elif pb <= pc: Pr = b
-            else: Pr = c
-
-            x = (x - Pr) & 0xff
-            out.append(x)
-            ai += 1
-
+    # On the first line there is no previous line, which is the same
+    # as a previous line of zeros: "up" becomes "none" and "paeth"
+    # becomes "sub".
+    if type == 0 or (type == 2 and not prev):
+        out.extend(line)
+        return out
     if not prev:
-        # We're on the first line.  Some of the filters can be reduced
-        # to simpler cases which makes handling the line "off the top"
-        # of the image simpler.  "up" becomes "none"; "paeth" becomes
-        # "left" (non-trivial, but true). "average" needs to be handled
-        # specially.
-        if type == 2: # "up"
-            return line # type = 0
+        prev = [0]*len(line)
+
+    if numpy is not None:
+        x = numpy_bytes(line).astype(numpy.int16)
+        b = numpy_bytes(prev).astype(numpy.int16)
+        # The bytes of the previous pixel (a) and the one above it (c).
+        a = numpy.zeros(len(x), numpy.int16)
+        a[fo:] = x[:-fo]
+        c = numpy.zeros(len(x), numpy.int16)
+        c[fo:] = b[:-fo]
+        if type == 1:
+            pr = a
+        elif type == 2:
+            pr = b
         elif type == 3:
-            prev = [0]*len(line)
-        elif type == 4: # "paeth"
-            type = 1
-    if type == 0:
-        out.extend(line)
-    elif type == 1:
-        sub()
+            pr = (a + b) >> 1
+        else:
+            # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - 2*c)
+            pr = numpy.where((pa <= pb) & (pa <= pc), a,
+                             numpy.where(pb <= pc, b, c))
+        out.fromstring(((x - pr) & 0xff).astype(numpy.uint8).tostring())
+        return out
+
+    line = list(line)
+    n = len(line)
+    a = ([0]*fo + line)[:n]
+    if type == 1:
+        out.extend([(x - ai) & 0xff for x,ai in zip(line, a)])
     elif type == 2:
-        up()
+        out.extend([(x - bi) & 0xff for x,bi in zip(line, prev)])
     elif type == 3:
-        average()
-    else: # type == 4
-        paeth()
+        out.extend([(x - ((ai + bi) >> 1)) & 0xff
+                    for x,ai,bi in zip(line, a, prev)])
+    else:
+        c = ([0]*fo + list(prev))[:n]
+        result = []
+        for x,ai,bi,ci in zip(line, a, prev, c):
+            pa = abs(bi - ci)
+            pb = abs(ai - ci)
+            pc = abs(ai + bi - ci - ci)
+            if pa <= pb and pa <= pc: pr = ai
+            elif pb <= pc: pr = bi
+            else: pr = ci
+            result.append((x - pr) & 0xff)
+        out.extend(result)
     return out
 
+def numpy_bytes(seq):
+    """Return a sequence of bytes as a numpy array (of ``uint8``)."""
+
+    if isarray(seq) and seq.typecode == 'B':
+        return numpy.frombuffer(tostring(seq), numpy.uint8)
+    return numpy.array(seq, numpy.uint8)
+
+def undo_filter_scanline(filter_type, scanline, previous, fu):
+    """Undo the filter of a scanline (see :meth:`Reader.undo_filter`)
+    whose filter unit (the stride from a byte to the corresponding
+    byte of the previous pixel) is `fu`, which must be a valid filter
+    type.  Returns a fresh array of bytes.
+
+    "none" and "up" are undone for the whole scanline at once, and so is
+    "sub" (as a running sum for each byte of a pixel) when numpy is
+    available.  "average" and "paeth" depend on the previous byte just
+    undone, so they are undone byte by byte on lists.
+    """
+
+    if filter_type == 0:
+        return array('B', scanline)
+    if not previous:
+        # On the first line "up" is the same as "none", "paeth" is the
+        # same as "sub" and "average" uses a previous line of zeros.
+        if filter_type == 2:
+            return array('B', scanline)
+        if filter_type == 4:
+            filter_type = 1
+        previous = [0]*len(scanline)
+
+    if numpy is not None and filter_type in (1,2):
+        x = numpy_bytes(scanline)
+        if filter_type == 2:
+            x = x + numpy_bytes(previous)
+        else:
+            x = x.reshape(-1, fu).cumsum(axis=0, dtype=numpy.uint8)
+        return array('B', x.tostring())
+
+    result = list(scanline)
+    n = len(result)
+    if filter_type == 1:
+        for i in range(fu, n):
+            result[i] = (result[i] + result[i-fu]) & 0xff
+    elif filter_type == 2:
+        result = [(x + b) & 0xff for x,b in zip(result, previous)]
+    elif filter_type == 3:
+        for i in range(min(fu, n)):
+            result[i] = (result[i] + (previous[i] >> 1)) & 0xff
+        for i in range(fu, n):
+            result[i] = (result[i] + ((result[i-fu] + previous[i]) >> 1)) & 0xff
+    else:
+        previous = list(previous)
+        for i in range(min(fu, n)):
+            result[i] = (result[i] + previous[i]) & 0xff
+        for i in range(fu, n):
+            a = result[i-fu]
+            b = previous[i]
+            c = previous[i-fu]
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - c - c)
+            if pa <= pb and pa <= pc: pr = a
+            elif pb <= pc: pr = b
+            else: pr = c
+            result[i] = (result[i] + pr) & 0xff
+    return array('B', result)
+
+def adaptive_filter(line, fo, prev=None):
+    """Apply the scanline filter (see :func:`filter_scanline`) which
+    gives the minimum sum of absolute differences (taking the filtered
+    bytes as signed) to a scanline.
+    """
+
+    best = None
+    for type in range(5):
+        out = filter_scanline(type, line, fo, prev)
+        if numpy is not None:
+            x = numpy_bytes(out[1:]).astype(numpy.int32)
+            cost = numpy.minimum(x, 256 - x).sum()
+        else:
+            cost = sum([min(x, 256 - x) for x in out[1:]])
+        if best is None or cost < best[0]:
+            best = (cost, out)
+    return best[1]
+
 
 class _readable:
     """
@@ -1192,21 +1523,7 @@ class Reader:
         result will be returned as a fresh sequence of bytes.
         """
 
-        # :todo: Would it be better to update scanline in place?
-
-        # Create the result byte array.  It seems that the best way to
-        # create the array to be the right size is to copy from an
-        # existing sequence.  *sigh*
-        # If we fill the result with scanline, then this allows a
-        # micro-optimisation in the "null" and "sub" cases.
-        result = array('B', scanline)
-
-        if filter_type == 0:
-            # And here, we _rely_ on filling the result with scanline,
-            # above.
-            return result
-
-        if filter_type not in (1,2,3,4):
+        if filter_type not in (0,1,2,3,4):
             raise FormatError('Invalid PNG Filter Type.'
               '  See http://www.w3.org/TR/2003/REC-PNG-20031110/#9Filters .')
 
@@ -1214,80 +1531,9 @@ class Reader:
         # byte from the previous previous.  Normally this is the pixel
         # size in bytes, but when this is smaller than 1, the previous
         # byte is used instead.
-        fu = max(1, self.psize)
-
-        # For the first line of a pass, synthesize a dummy previous
-        # line.  An alternative approach would be to observe that on the
-        # first line 'up' is the same as 'null', 'paeth' is the same
-        # as 'sub', with only 'average' requiring any special case.
-        if not previous:
-            previous = array('B', [0]*len(scanline))
-
-        def sub():
-            """Undo sub filter."""
-
-            ai = 0
-            # Loops starts at index fu.  Observe that the initial part
-            # of the result is already filled in correctly with
-            # scanline.
-            for i in range(fu, len(result)):
-                x = scanline[i]
-                a = result[ai]
-                result[i] = (x + a) & 0xff
-                ai += 1
-
-        def up():
-            """Undo up filter."""
-
-            for i in range(len(result)):
-                x = scanline[i]
-                b = previous[i]
-                result[i] = (x + b) & 0xff
-
-        def average():
-            """Undo average filter."""
-
-            ai = -fu
-            for i in range(len(result)):
-                x = scanline[i]
-                if ai < 0:
-                    a = 0
-                else:
-                    a = result[ai]
-                b = previous[i]
-                result[i] = (x + ((a + b) >> 1)) & 0xff
-                ai += 1
-
-        def paeth():
-            """Undo Paeth filter."""
-
-            # Also used for ci.
-            ai = -fu
-            for i in range(len(result)):
-                x = scanline[i]
-                if ai < 0:
-                    a = c = 0
-                else:
-                    a = result[ai]
-                    c = previous[ai]
-                b = previous[i]
-                p = a + b - c
-                pa = abs(p - a)
-                pb = abs(p - b)
-                pc = abs(p - c)
-                if pa <= pb and pa <= pc:
-                    pr = a
-                elif pb <= pc:
-                    pr = b
-                else:
-                    pr = c
-                result[i] = (x + pr) & 0xff
-                ai += 1
+        fu = max(1, int(self.psize))
 
-        # Call appropriate filter algorithm.  Note that 0 has already
-        # been dealt with.
-        (None, sub, up, average, paeth)[filter_type]()
-        return result
+        return undo_filter_scanline(filter_type, scanline, previous, fu)
 
     def deinterlace(self, raw):
         """
@@ -2404,6 +2650,123 @@ class Test(unittest.TestCase):
         d = hashlib.md5(''.join(map(chr, pixel))).digest()
         self.assertEqual(d.encode('hex'), '255cd971ab8cd9e7275ff906e5041aa0')
 
+    def testAdler32Combine(self):
+        """Test combining Adler-32 checksums."""
+
+        a = 'fractals' * 10000
+        b = ''.join(map(chr, range(256))) * 300
+        self.assertEqual(adler32_combine(zlib.adler32(a) & 0xffffffff,
+                                         zlib.adler32(b) & 0xffffffff,
+                                         len(b)),
+                         zlib.adler32(a + b) & 0xffffffff)
+    def testCompressionThreads(self):
+        """Test writing using several compression threads."""
+
+        rows = [[(x * y) % 256 for x in range(64)] for y in range(64)]
+        single = topngbytes('threads1.png', rows, 64, 64, greyscale=True)
+        for compression in (None, 1, 9):
+            b = topngbytes('threads4.png', rows, 64, 64, greyscale=True,
+                           chunk_limit=300, compression=compression,
+                           compression_threads=4)
+            r = Reader(bytes=b)
+            x,y,pixels,meta = r.asDirect()
+            self.assertEqual(map(list, pixels), rows)
+            idat = [''.join([data for tag,data in Reader(bytes=png).chunks()
+                             if tag == 'IDAT']).decode('zip')
+                    for png in (b, single)]
+            self.assertEqual(idat[0], idat[1])
+
+    def testFilterTypes(self):
+        """Test writing with each filter type, straight and interlaced."""
+
+        rows = [[(x * 3 + y * 5 + (x * y) % 7) % 256 for x in range(13)]
+                for y in range(11)]
+        for interlace in (False, True):
+            for filter_type in (None, 1, 2, 3, 4, 'adaptive'):
+                b = topngbytes('filter%s.png' % filter_type, rows, 13, 11,
+                               greyscale=True, interlace=interlace,
+                               filter_type=filter_type)
+                x,y,pixels,meta = Reader(bytes=b).asDirect()
+                self.assertEqual(map(list, pixels), rows)
+        rgb = [[(x * 20 + c * 50) % 256 for x in range(7) for c in range(3)]
+               for y in range(9)]
+        b = topngbytes('filterrgb.png', rgb, 7, 9, interlace=True,
+                       filter_type='adaptive')
+        x,y,pixels,meta = Reader(bytes=b).asDirect()
+        self.assertEqual(map(list, pixels), rgb)
+    def testFilterKernels(self):
+        """Test that filtering and undoing the filter of scanlines give
+        back the scanlines, with and without numpy."""
+
+        global numpy
+        line = array('B', [(x * 37 + (x * x) % 11) % 256 for x in range(48)])
+        prev = array('B', [(x * 91 + 7) % 256 for x in range(48)])
+        saved = numpy
+        try:
+            results = []
+            for numpy in set([saved, None]):
+                for fo in (1, 3, 6):
+                    for p in (None, prev):
+                        for type in range(5):
+                            out = filter_scanline(type, line, fo, p)
+                            self.assertEqual(out[0], type)
+                            self.assertEqual(
+                              undo_filter_scanline(type, out[1:], p, fo), line)
+                            results.append(out)
+                results.append(adaptive_filter(line, 3, prev))
+            n = len(results) // len(set([saved, None]))
+            self.assertEqual(results[:n], results[-n:])
+        finally:
+            numpy = saved
+    def testInterlacedRows(self):
+        """Test that writing an interlaced image from rows gives the same
+        file as writing it from an array."""
+
+        for width,height,planes,bitdepth in ((13, 11, 3, 8), (9, 7, 1, 16),
+                                             (1, 1, 3, 8), (5, 3, 1, 2)):
+            maxval = 2**bitdepth
+            rows = [[(x * 7 + y * 13) % maxval for x in range(width * planes)]
+                    for y in range(height)]
+            k = dict(greyscale=planes == 1, bitdepth=bitdepth, interlace=True,
+                     chunk_limit=16)
+            f = StringIO()
+            w = Writer(width, height, **k)
+            w.write_array(f, array('BH'[bitdepth > 8],
+                                   itertools.chain(*rows)))
+            b = topngbytes('interlacedrows.png', iter(rows), width, height,
+                           **k)
+            self.assertEqual(b, f.getvalue())
+            x,y,pixels,meta = Reader(bytes=b).asDirect()
+            self.assertEqual(map(list, pixels), rows)
+        self.assertRaises(ValueError, topngbytes, 'interlacedshort.png',
+                          [[0]*4]*2, 4, 3, greyscale=True, interlace=True)
+    def testPackers(self):
+        """Test writing 16-bit, sub-byte and rescaled bit depths."""
+
+        for bitdepth in (1, 2, 3, 4, 5, 12, 16):
+            maxval = 2**bitdepth
+            rows = [[(x * 7 + y * 3) % maxval for x in range(11)]
+                    for y in range(5)]
+            b = topngbytes('packer%d.png' % bitdepth, rows, 11, 5,
+                           greyscale=True, bitdepth=bitdepth)
+            x,y,pixels,meta = Reader(bytes=b).asDirect()
+            self.assertEqual(meta['bitdepth'], bitdepth)
+            self.assertEqual(map(list, pixels), rows)
+        rows = [[0x1234, 0xfedc, 0, 0xffff]]
+        b = topngbytes('packer16.png', rows, 4, 1, greyscale=True,
+                       bitdepth=16)
+        data = ''.join([data for tag,data in Reader(bytes=b).chunks()
+                        if tag == 'IDAT']).decode('zip')
+        self.assertEqual(data, '\x00\x12\x34\xfe\xdc\x00\x00\xff\xff')
+    def testPassStarts(self):
+        """Test the scanlines that start each pass."""
+
+        self.assertEqual(Writer(8, 8).pass_starts(), set([0]))
+        self.assertEqual(Writer(8, 8, interlace=True).pass_starts(),
+                         set([0, 1, 2, 3, 5, 7, 11]))
+        self.assertEqual(Writer(1, 1, interlace=True).pass_starts(),
+                         set([0]))
+
     # numpy dependent tests.  These are skipped (with a message to
     # sys.stderr) if numpy cannot be imported.
     def testNumpyuint16(self):
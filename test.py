@@ -12,15 +12,15 @@ maxIt = 150
 
 fractals = Fractals(num_procs=2)
 
-elems = fractals.mandelbrot(-2.5-1.5j, 1.5+1.5j, width, height, maxIt)
-img = []
-for row in elems:
-	rowImg = ()
-	for p in row:
-		rowImg += colors.color_pixels(p, maxIt, 'red')
-	img.append(rowImg)
+# Rows are calculated while the PNG file is written
+elems = fractals.mandelbrot_rows(-2.5-1.5j, 1.5+1.5j, width, height, maxIt)
+
+# Indexed colors: a byte for each pixel and the colors in the palette
+palette = colors.palette(maxIt, 'red')
+img = palette.index_image(elems)
 
 f = open('mandel.png', 'wb')
-w = png.Writer(width, height)
-w.write(f,img)
+w = png.Writer(width, height, palette=palette.entries)
+w.write_packed(f, img)
 f.close()
+fractals.close()
@@ -0,0 +1,422 @@
+# -.- coding: utf-8 -.-
+
+"""
+test_fractals.py
+
+Unit tests of fractals.py and colors.py, run them with
+``python test_fractals.py``
+"""
+
+from ctypes import c_uint8, c_uint16
+from decimal import Decimal
+from fractions import Fraction
+import pickle
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import fractals as fractals_module
+from fractals import Fractals
+import colors
+
+# The overview of the Mandelbrot set and of a Julia set
+MINIMUN = complex(-2, -1.5)
+MAXIMUN = complex(1, 1.5)
+JULIA_MINIMUN = complex(-1.5, -1)
+JULIA_MAXIMUN = complex(1.5, 1)
+C = complex(-0.8, 0.156)
+
+# A view of 1e-18 pixels in the Seahorse Valley
+CENTER = (Decimal('-0.743643887037158704752191506114774'),
+        Decimal('0.131825904205311970493132056385139'))
+RADIUS = Decimal('4e-18')
+# A view of 1e-10 pixels where most of them glitch with the reference in
+# its center
+GLITCH_CENTER = (Decimal('-1.768778833'), Decimal('-0.001738996'))
+GLITCH_RADIUS = Decimal('4e-10')
+# The engines that can be tested
+ENGINES = ('python',) if numpy is None else ('python', 'numpy')
+
+def mandelbrot(**options):
+    """
+    Returns the overview of the Mandelbrot set as a list of lists
+    """
+    options.setdefault('output', 'list')
+    with Fractals(**options) as fractals:
+        return fractals.mandelbrot(MINIMUN, MAXIMUN, 60, 45, 100)
+
+def julia(exp=2, **options):
+    """
+    Returns the overview of J(C) as a list of lists
+    """
+    options.setdefault('output', 'list')
+    with Fractals(**options) as fractals:
+        return fractals.julia(C, exp, JULIA_MINIMUN, JULIA_MAXIMUN, 60, 40,
+                100)
+
+def view(center, radius):
+    """
+    Returns the minimun and maximun of the view of `radius` around `center`
+    """
+    return ((center[0] - radius, center[1] - radius),
+            (center[0] + radius, center[1] + radius))
+
+def deep(center, radius, max_it, **options):
+    """
+    Returns the 8 x 8 table of the Mandelbrot set around `center` as a list
+    of lists
+    """
+    minimun, maximun = view(center, radius)
+    with Fractals(output='list', **options) as fractals:
+        return fractals.mandelbrot(minimun, maximun, 8, 8, max_it)
+
+def exact(center, radius, max_it, bits=200):
+    """
+    Same as `deep` iterating each pixel with python integers scaled by
+    2^`bits`, which is exact enough for the views of the tests
+    """
+    minimun, maximun = view(center, radius)
+    step = Fraction(2 * radius) / 8
+    table = []
+    for y in range(8):
+        row = []
+        for x in range(8):
+            c_real, c_imag = [(Fraction(start) + n * step) * 2 ** bits
+                for start, n in zip(minimun, (x, y))]
+            c_real, c_imag = int(c_real), int(c_imag)
+            real = imag = 0
+            count = max_it
+            for i in range(max_it):
+                real2 = real * real >> bits
+                imag2 = imag * imag >> bits
+                if real2 + imag2 > 16 << bits:
+                    count = i
+                    break
+                real, imag = (real2 - imag2 + c_real,
+                        (real * imag >> bits - 1) + c_imag)
+            row.append(count)
+        table.append(row)
+    return table
+
+class FractalsTest(unittest.TestCase):
+    def testProcesses(self):
+        """The tables do not depend on the number of processes"""
+        self.assertEqual(mandelbrot(num_procs=2), mandelbrot())
+        self.assertEqual(julia(num_procs=2, chunk_size=3), julia())
+
+    def testPool(self):
+        """The processes calculate every render until `close` is called"""
+        fractals = Fractals(num_procs=2, output='list')
+        table = fractals.mandelbrot(MINIMUN, MAXIMUN, 60, 45, 100)
+        self.assertEqual(table, mandelbrot())
+        self.assertEqual(fractals.julia(C, 2, JULIA_MINIMUN, JULIA_MAXIMUN,
+            60, 40, 100), julia())
+        fractals.close()
+        # They are started again by the next render
+        self.assertEqual(fractals.mandelbrot(MINIMUN, MAXIMUN, 60, 45, 100),
+                table)
+        fractals.close()
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def testEngines(self):
+        """Both engines return exactly the same values"""
+        self.assertEqual(mandelbrot(engine='numpy'), mandelbrot())
+        self.assertEqual(mandelbrot(engine='numpy', smooth=True),
+                mandelbrot(smooth=True))
+        for exp in (2, 3, 1.5):
+            self.assertEqual(julia(exp, engine='numpy'), julia(exp))
+
+    def testSmooth(self):
+        """The smooth count of a point is in [i, i + 1) for i iterations"""
+        for engine in ENGINES:
+            for smooth, table in ((mandelbrot(engine=engine, smooth=True),
+                    mandelbrot()), (julia(engine=engine, smooth=True),
+                    julia())):
+                self.assertEqual([[int(p) for p in row] for row in smooth],
+                        table)
+
+    def testOutputs(self):
+        """Tables, lists and numpy arrays hold the same values"""
+        table = mandelbrot(output='table')
+        self.assertEqual(len(table), 45)
+        self.assertEqual([list(row) for row in table], mandelbrot())
+        if numpy is not None:
+            array = mandelbrot(output='numpy')
+            self.assertEqual(array.shape, (45, 60))
+            self.assertEqual(array.tolist(), mandelbrot())
+
+    def testCompact(self):
+        """Compact tables hold the same counts in the smallest integers"""
+        table = mandelbrot(compact=True, output='table')
+        self.assertTrue(table._type_._type_ is c_uint8)
+        self.assertEqual([list(row) for row in table], mandelbrot())
+        with Fractals(compact=True) as fractals:
+            table = fractals.mandelbrot(MINIMUN, MAXIMUN, 6, 4, 1000)
+        self.assertTrue(table._type_._type_ is c_uint16)
+
+    def testMainBulbs(self):
+        """The points of the main cardioid and period-2 bulb do not escape"""
+        fractals = Fractals()
+        points = [complex(x / 40.0, y / 40.0)
+            for y in range(-20, 21) for x in range(-60, 21)]
+        inside = [c for c in points if fractals.in_main_bulbs(c)]
+        self.assertTrue(len(inside) > 100)
+        for c in inside:
+            z = 0j
+            for i in range(1000):
+                z = z * z + c
+            self.assertTrue(abs(z) <= 2)
+        if numpy is not None:
+            self.assertEqual(list(fractals.in_main_bulbs(numpy.array(points))),
+                    [fractals.in_main_bulbs(c) for c in points])
+
+    def testPeriodicity(self):
+        """The periodicity check does not change the counts"""
+        self.assertEqual(mandelbrot(periodicity=True), mandelbrot())
+        self.assertEqual(julia(periodicity=True), julia())
+        # Points next to -2 and i pass close to repelling cycles
+        with Fractals(output='list') as fractals:
+            table = fractals.mandelbrot(MINIMUN, MAXIMUN, 160, 120, 200)
+        for engine in ENGINES:
+            with Fractals(output='list', periodicity=True,
+                    engine=engine) as fractals:
+                self.assertEqual(fractals.mandelbrot(MINIMUN, MAXIMUN, 160,
+                    120, 200), table)
+        # The derivative is not defined at 0 for exponents smaller than 1
+        tables = []
+        for periodicity in (False, True):
+            with Fractals(output='list', periodicity=periodicity) as fractals:
+                tables.append(fractals.julia(C, 0.5, complex(-1, -1),
+                    complex(1, 1), 4, 4, 50))
+        self.assertEqual(tables[1], tables[0])
+        # Some pixels of a minibrot are found in the set much later than
+        # the others
+        minimun, maximun = complex(-1.79, -0.035), complex(-1.72, 0.035)
+        with Fractals(output='list') as fractals:
+            table = fractals.mandelbrot(minimun, maximun, 20, 20, 2000)
+        for engine in ENGINES:
+            with Fractals(output='list', periodicity=True,
+                    engine=engine) as fractals:
+                self.assertEqual(fractals.mandelbrot(minimun, maximun, 20,
+                    20, 2000), table)
+
+    def testSubdivide(self):
+        """Mariani-Silver gets the same tables for the overviews"""
+        self.assertEqual(mandelbrot(subdivide=True, tile_size=16),
+                mandelbrot())
+        self.assertEqual(julia(subdivide=True, tile_size=16), julia())
+        if numpy is not None:
+            self.assertEqual(mandelbrot(subdivide=True, tile_size=16,
+                engine='numpy'), mandelbrot())
+
+    def testTiles(self):
+        """The tiles of a zoom level are the pieces of the whole view"""
+        minimun, maximun = complex(-2, -2), complex(2, 2)
+        with Fractals(output='list') as fractals:
+            whole = fractals.mandelbrot(minimun, maximun, 32, 32, 100)
+            julia_whole = fractals.julia(C, 2, minimun, maximun, 32, 32, 100)
+            for tile_y in (0, 1):
+                for tile_x in (0, 1):
+                    piece = [row[16 * tile_x:16 * tile_x + 16]
+                        for row in whole[16 * tile_y:16 * tile_y + 16]]
+                    self.assertEqual(fractals.mandelbrot_tile(minimun,
+                        maximun, 1, tile_x, tile_y, 16, 100), piece)
+            self.assertEqual(fractals.julia_tile(C, 2, minimun, maximun, 2,
+                3, 1, 8, 100),
+                [row[24:32] for row in julia_whole[8:16]])
+            self.assertRaises(Exception, fractals.mandelbrot_tile, minimun,
+                    maximun, 1, 2, 0, 16, 100)
+
+    def testRows(self):
+        """The streamed rows are the rows of the table"""
+        with Fractals(output='list', num_procs=2) as fractals:
+            rows = list(fractals.mandelbrot_rows(MINIMUN, MAXIMUN, 60, 45,
+                100))
+        self.assertEqual(rows, mandelbrot())
+        with Fractals(output='list') as fractals:
+            rows = list(fractals.julia_rows(C, 2, JULIA_MINIMUN,
+                JULIA_MAXIMUN, 60, 40, 100))
+        self.assertEqual(rows, julia())
+
+    def testHistogram(self):
+        """The histogram counts every pixel of the table"""
+        with Fractals(collect_histogram=True, output='list') as fractals:
+            table = fractals.mandelbrot(MINIMUN, MAXIMUN, 60, 45, 100)
+            histogram = fractals.histogram
+        self.assertEqual(len(histogram), 101)
+        self.assertEqual(sum(histogram), 60 * 45)
+        for count, pixels in enumerate(histogram):
+            self.assertEqual(pixels,
+                    sum(row.count(count) for row in table))
+        # The histogram is not sent to the processes with each block
+        copy = pickle.loads(pickle.dumps(fractals))
+        self.assertEqual(copy.histogram, None)
+        self.assertEqual(copy.chosen_precision, None)
+
+    def testFixed(self):
+        """Fixed point counts are the ones of the floats for simple points"""
+        fractals = Fractals()
+        for c in (0.3 + 0.5j, -0.75 + 0.1j, 0.26, -1.3 + 0.04j, 0.3 - 0.6j):
+            self.assertEqual(fractals.fixed_mandelbrot(c, 500),
+                    fractals.in_mandelbrot(c, 500))
+            self.assertEqual(fractals.fixed_mandelbrot(
+                (str(c.real), str(c.imag)), 500),
+                fractals.in_mandelbrot(c, 500))
+            self.assertEqual(fractals.fixed_julia(c, C, 3, 100),
+                    fractals.in_julia(c, C, 3, 100))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def testSingle(self):
+        """Single precision only changes a few pixels of the boundary"""
+        single = mandelbrot(engine='numpy', precision='single')
+        changed = sum(a != b for row, other in zip(single, mandelbrot())
+            for a, b in zip(row, other))
+        self.assertTrue(changed < 60 * 45 // 50)
+        self.assertRaises(Exception, Fractals, precision='single')
+
+    def testAuto(self):
+        """'auto' reports the precision it chooses"""
+        fractals = Fractals(precision='auto')
+        fractals.mandelbrot(MINIMUN, MAXIMUN, 60, 45, 100)
+        self.assertEqual(fractals.chosen_precision, 'double')
+        # Generators of rows report it as soon as they are returned
+        minimun, maximun = view(CENTER, RADIUS)
+        fractals.mandelbrot_rows(minimun, maximun, 8, 8, 100)
+        self.assertEqual(fractals.chosen_precision, 'perturbation')
+        fractals.julia_rows(C, 3, minimun, maximun, 8, 8, 100)
+        self.assertEqual(fractals.chosen_precision, 'fixed')
+        self.assertRaises(Exception, fractals.julia_rows, C, 2.5, minimun,
+                maximun, 8, 8, 100)
+        if numpy is not None:
+            fractals = Fractals(precision='auto', engine='numpy')
+            fractals.mandelbrot(MINIMUN, MAXIMUN, 60, 45, 100)
+            self.assertEqual(fractals.chosen_precision, 'single')
+            fractals.mandelbrot_rows(minimun, maximun, 8, 8, 100)
+            self.assertEqual(fractals.chosen_precision, 'perturbation')
+
+    def testSymmetry(self):
+        """Mirrored rows are the same as calculated ones"""
+        self.assertEqual(mandelbrot(symmetry=True), mandelbrot())
+        self.assertEqual(julia(symmetry=True), julia())
+
+class DeepTest(unittest.TestCase):
+    """
+    The precisions for deep views, checked against exact counts
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.deep = exact(CENTER, RADIUS, 10000)
+        cls.glitch = exact(GLITCH_CENTER, GLITCH_RADIUS, 3000)
+
+    def testPerturbation(self):
+        """Perturbation gets the exact counts where floats are useless"""
+        self.assertTrue(len(set(v for row in self.deep for v in row)) > 10)
+        for engine in ENGINES:
+            self.assertEqual(deep(CENTER, RADIUS, 10000,
+                precision='perturbation', engine=engine), self.deep)
+
+    def testGlitches(self):
+        """Glitched pixels are calculated again with other references"""
+        for engine in ENGINES:
+            self.assertEqual(deep(GLITCH_CENTER, GLITCH_RADIUS, 3000,
+                precision='perturbation', engine=engine), self.glitch)
+        # With the reference in the center alone, the glitched pixels are
+        # calculated in fixed point
+        references = fractals_module.MAX_REFERENCES
+        fractals_module.MAX_REFERENCES = 1
+        try:
+            for engine in ENGINES:
+                self.assertEqual(deep(GLITCH_CENTER, GLITCH_RADIUS, 3000,
+                    precision='perturbation', engine=engine), self.glitch)
+        finally:
+            fractals_module.MAX_REFERENCES = references
+
+    def testDoubleDouble(self):
+        """Double-double gets the exact counts down to its precision"""
+        for engine in ENGINES:
+            self.assertEqual(deep(GLITCH_CENTER, GLITCH_RADIUS, 3000,
+                precision='double-double', engine=engine), self.glitch)
+        if numpy is not None:
+            self.assertEqual(deep(CENTER, RADIUS, 10000,
+                precision='double-double', engine='numpy'), self.deep)
+
+    def testFixed(self):
+        """Fixed point gets the exact counts"""
+        self.assertEqual(deep(CENTER, RADIUS, 10000, precision='fixed'),
+                self.deep)
+
+class PaletteTest(unittest.TestCase):
+    def rows(self, smooth=False):
+        """
+        Returns the table of the overview as lists, ctypes rows, a ctypes
+        table and a numpy array
+        """
+        with Fractals(smooth=smooth) as fractals:
+            table = fractals.mandelbrot(MINIMUN, MAXIMUN, 60, 45, 100)
+            streamed = list(fractals.mandelbrot_rows(MINIMUN, MAXIMUN, 60, 45,
+                100))
+        tables = [[list(row) for row in table], streamed, table]
+        if numpy is not None:
+            tables.append(numpy.ctypeslib.as_array(table))
+        return tables
+
+    def testPixels(self):
+        """The palette has the colors of `color_pixels`"""
+        for colour in ('red', 'gray', 'violet'):
+            palette = colors.Palette(100, colour)
+            for e in range(101):
+                self.assertEqual(palette.pixel(e),
+                        colors.color_pixels(e, 100, colour))
+            self.assertEqual(palette.pixel(2.5), palette.pixel(2))
+        self.assertTrue(colors.palette(100, 'red') is
+                colors.palette(100, 'red'))
+
+    def testImages(self):
+        """Every kind of row gets the same palette indexes and colors"""
+        palette = colors.Palette(100, 'red')
+        for method in (palette.index_image, palette.image):
+            images = [list(method(rows)) for rows in self.rows()]
+            for image in images[1:]:
+                self.assertEqual(image, images[0])
+
+    def testColors(self):
+        """The rows are the colors of `pixel`"""
+        for smooth in (False, True):
+            palette = colors.Palette(100, 'green', smooth=smooth)
+            for rows in self.rows(smooth):
+                for row, colored in zip(rows, palette.image(rows)):
+                    expected = []
+                    for p in row:
+                        expected.extend(palette.pixel(p))
+                    self.assertEqual(list(colored), expected)
+
+    def testIndexes(self):
+        """Palettes of more than 256 colors are reduced for PNG files"""
+        palette = colors.Palette(1000, 'red')
+        self.assertEqual(len(palette.entries), 256)
+        for e in range(1001):
+            self.assertEqual(palette.entries[palette.indexes[e]],
+                    palette.colors[palette.indexes[e] * 1000 // 255])
+        self.assertEqual(palette.indexes[0], 0)
+        self.assertEqual(palette.indexes[1000], 255)
+
+    def testEqualized(self):
+        """Equalized levels only grow with the counts that have pixels"""
+        with Fractals(collect_histogram=True) as fractals:
+            fractals.mandelbrot(MINIMUN, MAXIMUN, 60, 45, 100)
+            histogram = fractals.histogram
+        palette = colors.equalized(histogram)
+        self.assertEqual(len(palette.colors), 101)
+        for e in range(1, 100):
+            if not histogram[e]:
+                self.assertEqual(palette.colors[e], palette.colors[e - 1])
+        # The last escaped count gets the top level, the set is black
+        top = colors.Palette(100, levels=[255] * 100)
+        self.assertEqual(palette.colors[99], top.colors[0])
+        self.assertEqual(palette.colors[100], top.colors[100])
+
+if __name__ == '__main__':
+    unittest.main()